@@ -0,0 +1,245 @@
+"""
+chatbox/analytics.py
+
+Streaming funnel analytics for the template chatbots.
+
+The transitions of `ChatBotUser.process_message` bump a few counters, which are
+gathered in a `FunnelBatch` and written to the Redis store in a single round trip
+per message. A node is visited when the chatbot sends it (its message, or its
+prompt for the nodes waiting for an answer), so that the drop-offs are counted.
+* `FUNNEL_<bot>` holds the running totals, with one field per counter:
+  `visit:<node>`, `option:<node>:<idx>` and `error:<node>`.
+* `FUNNEL_<bot>_<minute>` holds the same counters for every minute, and expires.
+* `FUNNEL_HLL_<bot>_<node>` is a HyperLogLog of the sessions reaching the node.
+
+A report only reads these keys, so it costs O(nodes) whatever the traffic.
+`LocalFunnelRecorder` keeps the same counters in the memory of the process instead,
+for the deployments without a Redis store (see `CACHE_BACKEND=local`).
+"""
+
+import math
+import time
+import hashlib
+from threading import Lock
+
+
+def totals_key(bot):
+    return f"FUNNEL_{bot}"
+
+
+def minute_key(bot, minute):
+    return f"FUNNEL_{bot}_{minute}"
+
+
+def sessions_key(bot, node_id):
+    return f"FUNNEL_HLL_{bot}_{node_id}"
+
+
+class FunnelBatch():
+    """
+        The counters bumped while processing a message, written at once by `flush()`
+    """
+    def __init__(self, recorder):
+        self.recorder = recorder
+        # (bot, field) -> increment
+        self.counts = dict()
+        # (bot, node) -> sessions reaching the node
+        self.sessions = dict()
+
+
+    def add(self, bot, field):
+        self.counts[(bot, field)] = self.counts.get((bot, field), 0) + 1
+
+
+    def visit(self, bot, node_id, session_id):
+        """
+            Records a session reaching a node
+        """
+        self.add(bot, f"visit:{node_id}")
+        if session_id is not None:
+            self.sessions.setdefault((bot, node_id), []).append(session_id)
+
+
+    def option(self, bot, node_id, idx):
+        """
+            Records the choice of an option
+        """
+        self.add(bot, f"option:{node_id}:{idx}")
+
+
+    def error(self, bot, node_id):
+        """
+            Records an invalid answer
+        """
+        self.add(bot, f"error:{node_id}")
+
+
+    def flush(self):
+        if self.counts or self.sessions:
+            self.recorder.write(self.counts, self.sessions)
+        self.counts, self.sessions = dict(), dict()
+
+
+class FunnelRecorder():
+    """
+        Records the transitions of a chatbot on the Redis store
+    """
+    def __init__(self, redis_connection, minute_ttl=2 * 24 * 60 * 60):
+        self.redis_connection = redis_connection
+        self.minute_ttl = minute_ttl
+
+
+    def batch(self):
+        return FunnelBatch(self)
+
+
+    def write(self, counts, sessions):
+        """
+            Writes the counters of a batch, in one round trip
+        """
+        minute = int(time.time() // 60)
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for (bot, field), count in counts.items():
+                pipe.hincrby(totals_key(bot), field, count)
+                pipe.hincrby(minute_key(bot, minute), field, count)
+            for bot in {bot for bot, _ in counts}:
+                pipe.expire(minute_key(bot, minute), self.minute_ttl)
+            for (bot, node_id), session_ids in sessions.items():
+                pipe.pfadd(sessions_key(bot, node_id), *session_ids)
+            pipe.execute()
+
+
+    def report(self, bot, content, minutes=0):
+        return funnel_report(self.redis_connection, bot, content, minutes)
+
+
+class HyperLogLog():
+    """
+        Counts the distinct items approximately, in 2 ** `precision` bytes (like PFADD/PFCOUNT)
+    """
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+
+    def add(self, item):
+        value = int.from_bytes(hashlib.blake2b(str(item).encode('utf-8'), digest_size=8).digest(), 'big')
+        idx = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        self.registers[idx] = max(self.registers[idx], rank)
+
+
+    def count(self):
+        size = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting, for the small cardinalities
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+
+class LocalFunnelRecorder(FunnelRecorder):
+    """
+        Records the transitions of a chatbot in the memory of the process
+    """
+    def __init__(self, minute_ttl=2 * 24 * 60 * 60):
+        self.minute_ttl = minute_ttl
+        # Key -> {field -> count}, for the totals and the minutes
+        self.counters = dict()
+        # (bot, node) -> HyperLogLog of the sessions
+        self.sessions = dict()
+        # Minute key -> minute
+        self.minutes = dict()
+        self.lock = Lock()
+
+
+    def write(self, counts, sessions):
+        minute = int(time.time() // 60)
+        with self.lock:
+            for (bot, field), count in counts.items():
+                for key in (totals_key(bot), minute_key(bot, minute)):
+                    counters = self.counters.setdefault(key, dict())
+                    counters[field] = counters.get(field, 0) + count
+                if minute_key(bot, minute) not in self.minutes:
+                    self.minutes[minute_key(bot, minute)] = minute
+                    self.expire(minute)
+            for (bot, node_id), session_ids in sessions.items():
+                hll = self.sessions.setdefault((bot, node_id), HyperLogLog())
+                for session_id in session_ids:
+                    hll.add(session_id)
+
+
+    def expire(self, now):
+        for key, minute in list(self.minutes.items()):
+            if (now - minute) * 60 > self.minute_ttl:
+                del self.minutes[key]
+                self.counters.pop(key, None)
+
+
+    def report(self, bot, content, minutes=0):
+        now = int(time.time() // 60)
+        nodes = [node for node in content['node'] if 'id' in node]
+        with self.lock:
+            totals = dict(self.counters.get(totals_key(bot), dict()))
+            sessions = [
+                self.sessions[(bot, node['id'])].count() if (bot, node['id']) in self.sessions else 0
+                for node in nodes
+            ]
+            per_minute = [
+                dict(self.counters.get(minute_key(bot, minute), dict()))
+                for minute in range(now - minutes + 1, now + 1)
+            ]
+        return build_report(nodes, totals, sessions, per_minute, minutes)
+
+
+def funnel_report(redis_connection, bot, content, minutes=0):
+    """
+        Builds the funnel report of a bot, given the content of its template.
+        With `minutes`, also includes the visits of every node during the last minutes.
+    """
+    nodes = [node for node in content['node'] if 'id' in node]
+    now = int(time.time() // 60)
+
+    with redis_connection.pipeline(transaction=False) as pipe:
+        pipe.hgetall(totals_key(bot))
+        for node in nodes:
+            pipe.pfcount(sessions_key(bot, node['id']))
+        for minute in range(now - minutes + 1, now + 1):
+            pipe.hgetall(minute_key(bot, minute))
+        results = pipe.execute()
+
+    totals = {key.decode('utf-8'): int(value) for key, value in results[0].items()}
+    sessions = results[1:len(nodes) + 1]
+    per_minute = [
+        {key.decode('utf-8'): int(value) for key, value in counters.items()}
+        for counters in results[len(nodes) + 1:]
+    ]
+    return build_report(nodes, totals, sessions, per_minute, minutes)
+
+
+def build_report(nodes, totals, sessions, per_minute, minutes):
+    """
+        Builds the funnel report of the nodes, from the counters of their bot
+    """
+    report = []
+    for node, unique_sessions in zip(nodes, sessions):
+        node_id = node['id']
+        entry = {
+            'id': node_id,
+            'visits': totals.get(f"visit:{node_id}", 0),
+            'sessions': unique_sessions,
+            'errors': totals.get(f"error:{node_id}", 0),
+        }
+        if 'options' in node:
+            entry['options'] = {
+                option: totals.get(f"option:{node_id}:{idx}", 0)
+                for idx, option in enumerate(node['options'])
+            }
+        if minutes:
+            entry['per_minute'] = [
+                counters.get(f"visit:{node_id}", 0) for counters in per_minute
+            ]
+        report.append(entry)
+    return report
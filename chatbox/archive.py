@@ -0,0 +1,406 @@
+"""
+chatbox/archive.py
+
+The archive backends, which persist the sessions flushed from the Redis cache.
+
+`update_session_db` hands every batch of cached messages of a room to the
+configured backend:
+* `ORMArchiveBackend` stores a `ChatboxMessage` row per message.
+* `SegmentLogArchiveBackend` appends the messages to a per-day segment file,
+  with a compact binary record format and a sparse (room, msg_num) index.
+  Reads go through mmap, and never touch the relational database.
+"""
+
+import os
+import mmap
+import time
+import uuid
+import struct
+import zlib
+from datetime import datetime, timezone
+from threading import Lock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction, IntegrityError
+
+from .serializers import ChatBoxMessageSerializer
+from .models import ChatboxMessage
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only the segment backend needs it, to lock the segments
+    fcntl = None
+
+
+class ArchiveBackend():
+    """
+        The interface of an archive backend.
+        A message is a dict with the fields of a `ChatboxMessage`.
+    """
+    def write_batch(self, room_name, messages):
+        """
+            Archives a batch of messages of a room
+        """
+        raise NotImplementedError
+
+
+    def write_bulk(self, messages):
+        """
+            Archives the messages of many rooms at once. By default, this writes a batch per room.
+        """
+        by_room = dict()
+        for content in messages:
+            by_room.setdefault(content['chat_room'], []).append(content)
+        for room_name, room_msgs in by_room.items():
+            self.write_batch(room_name, room_msgs)
+
+
+    def read_history(self, room_name, room_id, start=1, stop=None):
+        """
+            Gets the archived messages of a room (with the uuid `room_id`) with start <= msg_num < stop, in order
+        """
+        raise NotImplementedError
+
+
+    def read_recent(self, room_name, room_id, count):
+        """
+            Gets the last `count` archived messages of a room (with the uuid `room_id`), in order
+        """
+        raise NotImplementedError
+
+
+class ORMArchiveBackend(ArchiveBackend):
+    """
+        Stores a ChatboxMessage row per message, in the default database
+    """
+    def write_batch(self, room_name, messages):
+        for content in messages:
+            print(f"Content: {content}")
+
+            # Using a serializer here, as otherwise, getting the instance of
+            # ChatRoom and passing it to the ChatboxMsg instance is painful
+            serializer = ChatBoxMessageSerializer(data=content)
+
+            try:
+                if serializer.is_valid():
+                    with transaction.atomic():
+                        serializer.save()
+            except IntegrityError:
+                print('PK for ChatRoomMessage is already there in DB!')
+
+
+    def write_bulk(self, messages):
+        # A single multi-row insert, skipping the messages which are already archived
+        ChatboxMessage.objects.bulk_create([
+            ChatboxMessage(
+                chat_room=content['chat_room'],
+                room_id_id=content['room_id'],
+                user_name=content['user_name'],
+                msg_num=int(content['msg_num']),
+                message=content['message'],
+            ) for content in messages
+        ], batch_size=500, ignore_conflicts=True)
+
+
+    # The reads go through the (room_id, msg_num) unique index, since chat_room has no index
+
+    def read_history(self, room_name, room_id, start=1, stop=None):
+        queryset = ChatboxMessage.objects.filter(room_id_id=room_id, msg_num__gte=start)
+        if stop is not None:
+            queryset = queryset.filter(msg_num__lt=stop)
+        return [self.to_dict(obj) for obj in queryset.order_by('msg_num')]
+
+
+    def read_recent(self, room_name, room_id, count):
+        queryset = ChatboxMessage.objects.filter(room_id_id=room_id).order_by('-msg_num')[:count]
+        return [self.to_dict(obj) for obj in reversed(queryset)]
+
+
+    @staticmethod
+    def to_dict(obj):
+        return {
+            'chat_room': obj.chat_room,
+            'room_id': str(obj.room_id_id),
+            'user_name': obj.user_name,
+            'msg_num': obj.msg_num,
+            'message': obj.message,
+        }
+
+
+# A record: crc32 of the rest of the record, msg_num, timestamp, room_id,
+# followed by the lengths of the room name, the user name and the message, and their bytes
+RECORD_HEADER = struct.Struct('<IIdHHI16s')
+
+# A sparse index entry, one per written batch:
+# crc32 of the room name, first msg_num, last msg_num, number of records, offset of the batch in the segment
+INDEX_ENTRY = struct.Struct('<IIIIQ')
+
+# The extension of the sparse indexes
+INDEX_EXTENSION = '.index'
+
+
+def room_hash(room_name):
+    return zlib.crc32(room_name.encode('utf-8'))
+
+
+def encode_record(content, timestamp):
+    """
+        Encodes a message as a segment record
+    """
+    room = content['chat_room'].encode('utf-8')
+    user = content['user_name'].encode('utf-8')
+    message = content['message'].encode('utf-8')
+    body = RECORD_HEADER.pack(
+        0, int(content['msg_num']), timestamp, len(room), len(user), len(message),
+        uuid.UUID(str(content['room_id'])).bytes
+    )[4:] + room + user + message
+    return struct.pack('<I', zlib.crc32(body)) + body
+
+
+def decode_record(buffer, offset):
+    """
+        Decodes the segment record at `offset`. Returns the message, and the offset of the next record
+    """
+    crc, msg_num, timestamp, room_len, user_len, msg_len, room_id = \
+        RECORD_HEADER.unpack_from(buffer, offset)
+    start = offset + RECORD_HEADER.size
+    end = start + room_len + user_len + msg_len
+    if zlib.crc32(buffer[offset + 4:end]) != crc:
+        raise ValueError(f"Corrupt archive record at offset {offset}")
+    room = bytes(buffer[start:start + room_len]).decode('utf-8')
+    user = bytes(buffer[start + room_len:start + room_len + user_len]).decode('utf-8')
+    message = bytes(buffer[start + room_len + user_len:end]).decode('utf-8')
+    return {
+        'chat_room': room,
+        'room_id': str(uuid.UUID(bytes=room_id)),
+        'user_name': user,
+        'msg_num': msg_num,
+        'message': message,
+        'timestamp': timestamp,
+    }, end
+
+
+def segment_records(buffer):
+    """
+        Iterates over the records of a segment, as (offset, message), stopping at a partially written batch
+    """
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(buffer):
+        try:
+            content, end = decode_record(buffer, offset)
+        except (ValueError, struct.error):
+            return
+        yield offset, content
+        offset = end
+
+
+class SegmentLogArchiveBackend(ArchiveBackend):
+    """
+        Appends the messages to a segment file per day (`<directory>/<YYYY-MM-DD>.seg`).
+        Every batch is written sequentially, and gets one entry in the sparse
+        index of the segment (`<YYYY-MM-DD>.index`). A missing index is rebuilt
+        from its segment.
+
+        Every worker keeps the days on which each room has batches, so that reading
+        a room only opens the segments of that room.
+    """
+    def __init__(self, directory):
+        if fcntl is None:
+            raise ImproperlyConfigured(
+                "ARCHIVE_BACKEND 'segment' locks its segments with fcntl, which this platform lacks. "
+                "Use ARCHIVE_BACKEND 'orm' instead."
+            )
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Day -> (bytes of the index read so far, {room hash -> index entries})
+        self.indexes = dict()
+        # Room hash -> days with a batch of the room
+        self.room_days = dict()
+        self.lock = Lock()
+
+
+    def segment_paths(self, day):
+        base = os.path.join(self.directory, day)
+        return base + '.seg', base + INDEX_EXTENSION
+
+
+    def days(self):
+        """
+            The days with a segment, oldest first
+        """
+        return sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+
+    def write_batch(self, room_name, messages):
+        if not messages:
+            return
+        timestamp = time.time()
+        day = datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%d')
+        segment_path, index_path = self.segment_paths(day)
+
+        messages = sorted(messages, key=lambda content: int(content['msg_num']))
+        records = b''.join(encode_record(content, timestamp) for content in messages)
+
+        with open(segment_path, 'ab') as segment:
+            # Other workers may append to the same segment
+            fcntl.flock(segment.fileno(), fcntl.LOCK_EX)
+            try:
+                offset = os.fstat(segment.fileno()).st_size
+                if offset > 0 and not os.path.exists(index_path):
+                    self.rebuild_index(segment_path, index_path)
+                segment.write(records)
+                segment.flush()
+                with open(index_path, 'ab') as index:
+                    index.write(INDEX_ENTRY.pack(
+                        room_hash(room_name), int(messages[0]['msg_num']),
+                        int(messages[-1]['msg_num']), len(messages), offset
+                    ))
+            finally:
+                fcntl.flock(segment.fileno(), fcntl.LOCK_UN)
+
+
+    @staticmethod
+    def rebuild_index(segment_path, index_path):
+        """
+            Writes the sparse index of a segment from its records, with an entry per run
+            of records of the same room. This must be called with the segment locked.
+        """
+        entries = []
+        with open(segment_path, 'rb') as segment:
+            if os.fstat(segment.fileno()).st_size > 0:
+                with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    for offset, content in segment_records(buffer):
+                        last = entries[-1] if entries else None
+                        if last is not None and last[0] == content['chat_room'] and last[2] < content['msg_num']:
+                            last[2] = content['msg_num']
+                            last[3] += 1
+                        else:
+                            entries.append([content['chat_room'], content['msg_num'],
+                                            content['msg_num'], 1, offset])
+        with open(index_path + '.tmp', 'wb') as index:
+            for room_name, first_msg, last_msg, num_records, offset in entries:
+                index.write(INDEX_ENTRY.pack(room_hash(room_name), first_msg, last_msg, num_records, offset))
+        os.replace(index_path + '.tmp', index_path)
+
+
+    def load_index(self, day):
+        """
+            Gets the entries of the sparse index of a day per room hash, reading only what has been appended
+        """
+        segment_path, index_path = self.segment_paths(day)
+        if not os.path.exists(index_path):
+            try:
+                segment = open(segment_path, 'rb')
+            except FileNotFoundError:
+                return dict()
+            with segment:
+                fcntl.flock(segment.fileno(), fcntl.LOCK_EX)
+                try:
+                    if not os.path.exists(index_path):
+                        self.rebuild_index(segment_path, index_path)
+                finally:
+                    fcntl.flock(segment.fileno(), fcntl.LOCK_UN)
+
+        with self.lock:
+            read, entries = self.indexes.get(day, (0, dict()))
+            try:
+                size = os.path.getsize(index_path)
+            except FileNotFoundError:
+                return entries
+            # Ignore a partially written entry
+            size -= size % INDEX_ENTRY.size
+            if size > read:
+                with open(index_path, 'rb') as index:
+                    index.seek(read)
+                    content = index.read(size - read)
+                for entry in INDEX_ENTRY.iter_unpack(content):
+                    entries.setdefault(entry[0], []).append(entry)
+                    self.room_days.setdefault(entry[0], set()).add(day)
+                read = size
+            self.indexes[day] = (read, entries)
+            return entries
+
+
+    def refresh(self):
+        """
+            Loads the indexes of the new days, and of the last two days, which may still grow.
+            The older days are final, since batches are only ever appended to the segment of the day.
+        """
+        days = self.days()
+        for idx, day in enumerate(days):
+            if day not in self.indexes or idx >= len(days) - 2:
+                self.load_index(day)
+        with self.lock:
+            # Forget the days pruned by the retention
+            removed = set(self.indexes) - set(days)
+            if removed:
+                for day in removed:
+                    del self.indexes[day]
+                for room_days in self.room_days.values():
+                    room_days -= removed
+
+
+    def days_of(self, room_name):
+        """
+            The days with a batch of a room, oldest first
+        """
+        self.refresh()
+        with self.lock:
+            return sorted(self.room_days.get(room_hash(room_name), ()))
+
+
+    def read_segment(self, day, room_name, start, stop):
+        """
+            Gets the messages of a room in a segment, using the sparse index to find its batches
+        """
+        segment_path, _ = self.segment_paths(day)
+        entries = self.load_index(day).get(room_hash(room_name), [])
+        if entries == []:
+            return []
+
+        try:
+            segment = open(segment_path, 'rb')
+        except FileNotFoundError:
+            # Pruned by the retention in the meantime
+            return []
+        msgs = []
+        with segment:
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for _, first_msg, last_msg, num_records, offset in entries:
+                    if last_msg < start or (stop is not None and first_msg >= stop):
+                        # The batch is sorted, so we can skip it entirely
+                        continue
+                    for _ in range(num_records):
+                        content, offset = decode_record(buffer, offset)
+                        if content['chat_room'] != room_name or content['msg_num'] < start:
+                            continue
+                        if stop is not None and content['msg_num'] >= stop:
+                            break
+                        msgs.append(content)
+        return msgs
+
+
+    def read_history(self, room_name, room_id, start=1, stop=None):
+        msgs = dict()
+        for day in self.days_of(room_name):
+            for content in self.read_segment(day, room_name, start, stop):
+                msgs[content['msg_num']] = content
+        return [msgs[msg_num] for msg_num in sorted(msgs)]
+
+
+    def read_recent(self, room_name, room_id, count):
+        msgs = dict()
+        for day in reversed(self.days_of(room_name)):
+            for content in self.read_segment(day, room_name, 1, None):
+                msgs.setdefault(content['msg_num'], content)
+            if len(msgs) >= count:
+                break
+        return [msgs[msg_num] for msg_num in sorted(msgs)[-count:]]
+
+
+# Name of the backend -> Class of the backend
+ARCHIVE_BACKENDS = {
+    'orm': ORMArchiveBackend,
+    'segment': SegmentLogArchiveBackend,
+}
@@ -0,0 +1,395 @@
+"""
+chatbox/cache.py
+
+The cache stores, which hold the live sessions until they are archived.
+
+The chat paths only need a narrow subset of the Redis commands, and only go
+through this subset (see `CacheStore`):
+* `RedisCacheStore` forwards it to a Redis server, shared by every worker.
+* `LocalCacheStore` keeps everything in the memory of the process, with a cap on
+  the memory and the number of keys (evicting the least recently used keys),
+  and optional TTLs. This suits single-box deployments with a single worker,
+  and skips the network round trips entirely.
+
+Like Redis, the stores take str/int/float/bytes values, and give back bytes.
+"""
+
+import time
+from collections import OrderedDict
+from threading import RLock
+
+
+class CacheStore():
+    """
+        The interface of a cache store
+    """
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ex=None):
+        raise NotImplementedError
+
+    def setnx(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def expire(self, key, seconds):
+        raise NotImplementedError
+
+    def hset(self, key, field, value):
+        raise NotImplementedError
+
+    def hget(self, key, field):
+        raise NotImplementedError
+
+    def hmset(self, key, mapping):
+        raise NotImplementedError
+
+    def hgetall(self, key):
+        raise NotImplementedError
+
+    def hscan_iter(self, key, count=None):
+        raise NotImplementedError
+
+    def lpush(self, key, *values):
+        raise NotImplementedError
+
+    def ltrim(self, key, start, stop):
+        raise NotImplementedError
+
+    def lrange(self, key, start, stop):
+        raise NotImplementedError
+
+    def pipeline(self, transaction=True):
+        """
+            Batches commands, which are run at once by `execute()`.
+            Supports `watch()` and `multi()` for optimistic transactions.
+        """
+        raise NotImplementedError
+
+
+class RedisCacheStore(CacheStore):
+    """
+        Forwards the commands to a Redis server
+    """
+    def __init__(self, redis_connection):
+        self.redis_connection = redis_connection
+
+    def get(self, key):
+        return self.redis_connection.get(key)
+
+    def set(self, key, value, ex=None):
+        return self.redis_connection.set(key, value, ex=ex)
+
+    def setnx(self, key, value):
+        return self.redis_connection.setnx(key, value)
+
+    def delete(self, *keys):
+        return self.redis_connection.delete(*keys)
+
+    def expire(self, key, seconds):
+        return self.redis_connection.expire(key, seconds)
+
+    def hset(self, key, field, value):
+        return self.redis_connection.hset(key, field, value)
+
+    def hget(self, key, field):
+        return self.redis_connection.hget(key, field)
+
+    def hmset(self, key, mapping):
+        return self.redis_connection.hmset(key, mapping)
+
+    def hgetall(self, key):
+        return self.redis_connection.hgetall(key)
+
+    def hscan_iter(self, key, count=None):
+        return self.redis_connection.hscan_iter(key, count=count)
+
+    def lpush(self, key, *values):
+        return self.redis_connection.lpush(key, *values)
+
+    def ltrim(self, key, start, stop):
+        return self.redis_connection.ltrim(key, start, stop)
+
+    def lrange(self, key, start, stop):
+        return self.redis_connection.lrange(key, start, stop)
+
+    def pipeline(self, transaction=True):
+        return self.redis_connection.pipeline(transaction=transaction)
+
+
+def encode(value):
+    """
+        Encodes a value the way redis-py does
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, (int, float)):
+        return repr(value).encode('utf-8')
+    raise TypeError(f"Cannot cache a value of type {type(value).__name__}")
+
+
+def list_slice(start, stop, length):
+    """
+        Converts an inclusive Redis range (with negative indexes) to a slice
+    """
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop = length + stop
+    return slice(start, stop + 1)
+
+
+# The overhead of a key, and of an item of a hash or a list, in bytes (roughly those of Redis)
+KEY_OVERHEAD = 64
+ITEM_OVERHEAD = 16
+
+
+class Entry():
+    __slots__ = ('value', 'expires_at', 'size')
+
+    def __init__(self, value, expires_at):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = 0
+
+
+class LocalCacheStore(CacheStore):
+    """
+        Keeps the cache in the memory of the process.
+        Once there are more than `max_keys` keys, or they use more than `max_bytes` bytes,
+        the least recently used keys are evicted. Every new key expires after `default_ttl`
+        seconds (0 for never), unless given another TTL with `set(ex=...)` or `expire()`.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_keys=100000, default_ttl=0):
+        self.max_bytes = max_bytes
+        self.max_keys = max_keys
+        self.default_ttl = default_ttl
+        # Key -> Entry, least recently used first
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+        self.evictions = 0
+        self.lock = RLock()
+
+
+    def lookup(self, key, kind=None):
+        """
+            Gets the live entry of a key, marking it as recently used
+        """
+        key = encode(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at is not None and entry.expires_at <= time.monotonic():
+            self.remove(key)
+            return None
+        if kind is not None and not isinstance(entry.value, kind):
+            raise TypeError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        self.entries.move_to_end(key)
+        return entry
+
+
+    def create(self, key, value, ttl=None):
+        key = encode(key)
+        self.remove(key)
+        ttl = self.default_ttl if ttl is None else ttl
+        entry = Entry(value, time.monotonic() + ttl if ttl else None)
+        self.entries[key] = entry
+        self.resize(entry, KEY_OVERHEAD + len(key))
+        return entry
+
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        self.used_bytes -= entry.size
+        return True
+
+
+    def resize(self, entry, delta):
+        entry.size += delta
+        self.used_bytes += delta
+
+
+    def evict(self):
+        """
+            Evicts the least recently used keys, until the store is within its caps
+        """
+        while self.entries and (self.used_bytes > self.max_bytes or len(self.entries) > self.max_keys):
+            key, entry = self.entries.popitem(last=False)
+            self.used_bytes -= entry.size
+            self.evictions += 1
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.lookup(key, bytes)
+            return None if entry is None else entry.value
+
+
+    def set(self, key, value, ex=None):
+        value = encode(value)
+        with self.lock:
+            entry = self.create(key, value, ex)
+            self.resize(entry, len(value))
+            self.evict()
+            return True
+
+
+    def setnx(self, key, value):
+        with self.lock:
+            if self.lookup(key) is not None:
+                return False
+            return self.set(key, value)
+
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self.remove(encode(key)) for key in keys)
+
+
+    def expire(self, key, seconds):
+        with self.lock:
+            entry = self.lookup(key)
+            if entry is None:
+                return False
+            entry.expires_at = time.monotonic() + seconds
+            return True
+
+
+    def hash_entry(self, key):
+        entry = self.lookup(key, dict)
+        if entry is None:
+            entry = self.create(key, dict())
+        return entry
+
+
+    def hset(self, key, field, value):
+        field, value = encode(field), encode(value)
+        with self.lock:
+            entry = self.hash_entry(key)
+            old = entry.value.get(field)
+            if old is None:
+                self.resize(entry, ITEM_OVERHEAD + len(field) + len(value))
+            else:
+                self.resize(entry, len(value) - len(old))
+            entry.value[field] = value
+            self.evict()
+            return int(old is None)
+
+
+    def hget(self, key, field):
+        with self.lock:
+            entry = self.lookup(key, dict)
+            return None if entry is None else entry.value.get(encode(field))
+
+
+    def hmset(self, key, mapping):
+        with self.lock:
+            for field, value in mapping.items():
+                self.hset(key, field, value)
+            return True
+
+
+    def hgetall(self, key):
+        with self.lock:
+            entry = self.lookup(key, dict)
+            return dict() if entry is None else dict(entry.value)
+
+
+    def hscan_iter(self, key, count=None):
+        # Iterates over a snapshot, so that the hash may change in the meantime
+        return iter(list(self.hgetall(key).items()))
+
+
+    def lpush(self, key, *values):
+        values = [encode(value) for value in values]
+        with self.lock:
+            entry = self.lookup(key, list)
+            if entry is None:
+                entry = self.create(key, list())
+            for value in values:
+                entry.value.insert(0, value)
+                self.resize(entry, ITEM_OVERHEAD + len(value))
+            self.evict()
+            return len(entry.value)
+
+
+    def ltrim(self, key, start, stop):
+        with self.lock:
+            entry = self.lookup(key, list)
+            if entry is None:
+                return True
+            kept = entry.value[list_slice(start, stop, len(entry.value))]
+            removed = sum(ITEM_OVERHEAD + len(value) for value in entry.value) - \
+                sum(ITEM_OVERHEAD + len(value) for value in kept)
+            entry.value = kept
+            self.resize(entry, -removed)
+            if kept == []:
+                self.remove(encode(key))
+            return True
+
+
+    def lrange(self, key, start, stop):
+        with self.lock:
+            entry = self.lookup(key, list)
+            if entry is None:
+                return []
+            return entry.value[list_slice(start, stop, len(entry.value))]
+
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+
+class LocalPipeline():
+    """
+        Batches the commands of a `LocalCacheStore`, and runs them under its lock.
+        Every batch is atomic, so `watch()` never fails.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.commands = []
+        self.immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+
+    def watch(self, *keys):
+        # Run the commands immediately, until multi()
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def execute(self):
+        with self.store.lock:
+            results = [getattr(self.store, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+    def __getattr__(self, name):
+        if name not in CacheStore.__dict__ or name == 'pipeline':
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if self.immediate:
+                return getattr(self.store, name)(*args, **kwargs)
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+
+# Name of the store -> Class of the store
+CACHE_STORES = {
+    'redis': RedisCacheStore,
+    'local': LocalCacheStore,
+}
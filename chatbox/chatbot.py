@@ -1,8 +1,10 @@
 import re
 import os
 import json
-from decouple import Config, RepositoryEnv, UndefinedValueError
-from redis import StrictRedis
+from threading import Lock
+
+from .conf import config
+from .matching import OptionMatcher
 
 room_to_chatbot_user = {
     # Contains a mapping from the room names to the Chatbot Users
@@ -11,38 +13,96 @@ room_to_chatbot_user = {
     'default': 'Gerald',
 }
 
-class ChatBotUser():
-    def __init__(self, chatbot_user, template, redis_connection):
-        self.name = chatbot_user
-        self.content, self.hashmap = self.process_template(template)
-        self.state = 1
-        self.redis_connection = redis_connection
-    
-    def process_template(self, template_json):
-        # We'll process the template JSON and put it into a Database
+def template_path(chatbot_user):
+    # The template JSON file of a Chatbot User
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "templates", "chatbox", chatbot_user + ".json")
+
+
+def variables_key(room_name):
+    # The hash holding the variables stored by the chatbot for a conversation
+    return f"VARIABLES_{room_name}"
+
+
+class ChatBotTemplate():
+    """
+        A template JSON file, compiled once for all the sessions of its chatbot
+    """
+    def __init__(self, template_json):
         file_obj = open(template_json, 'rb')
-        content = json.load(file_obj)
+        self.content = json.load(file_obj)
         file_obj.close()
 
         # Create a hashmap to sequentially order the id's
-        hashmap = dict()
+        self.hashmap = dict()
         curr = 1
-        for node in content['node']:
+        for node in self.content['node']:
             if 'id' in node:
-                hashmap[node['id']] = curr
+                self.hashmap[node['id']] = curr
                 curr += 1
-        return content, hashmap
+
+        # Node position -> the lookup index of its options
+        self.matchers = dict()
+        for position, node in enumerate(self.content['node']):
+            if 'options' in node:
+                self.matchers[position] = OptionMatcher(
+                    node['options'],
+                    min_prefix=config.MATCH_MIN_PREFIX,
+                    token_threshold=config.MATCH_TOKEN_THRESHOLD,
+                )
+
+
+# Template path -> (modification time, compiled template)
+TEMPLATES = dict()
+TEMPLATES_LOCK = Lock()
+
+
+def load_template(template_json):
+    """
+        Gets the compiled template of a path, compiling it again if the file changed
+    """
+    mtime = os.stat(template_json).st_mtime
+    with TEMPLATES_LOCK:
+        cached = TEMPLATES.get(template_json)
+        if cached is None or cached[0] != mtime:
+            cached = TEMPLATES[template_json] = (mtime, ChatBotTemplate(template_json))
+        return cached[1]
+
+
+class ChatBotUser():
+    def __init__(self, chatbot_user, template, cache, room_name, session_id=None, funnel=None):
+        self.name = chatbot_user
+        # The conversation, which keys the stored variables
+        self.room_name = room_name
+        self.template = load_template(template)
+        self.content, self.hashmap = self.template.content, self.template.hashmap
+        self.state = 1
+        self.cache = cache
+        # The funnel analytics recorder (see chatbox/analytics.py), and the session to record for
+        self.session_id = session_id
+        self.funnel = funnel
+        # The funnel counters of the message being processed
+        self.events = None
+    
+    @staticmethod
+    def process_template(template_json):
+        # The content of the template JSON, and its hashmap of the node id's
+        template = load_template(template_json)
+        return template.content, template.hashmap
     
 
     def insert_placeholders(self, message, has_options):
-        # Hello {username} => Hello {redis_connection.get('username')}
+        # Hello {username} => Hello {the 'username' variable of the conversation}
         pattern = r"\{([A-Za-z0-9_]+)\}"
         encoding = 'utf-8'
         def replace_function(match):
             # Strip away the '{' and '}' from the match string
-            match = match.group()[1:-1]
-            # Redis gives us a byte string. Decode that to 'utf-8' and convert to a string
-            return str(self.redis_connection.get(match).decode(encoding))
+            value = self.cache.hget(variables_key(self.room_name), match.group()[1:-1])
+            if value is None:
+                # Never stored, or reaped with the session: leave the placeholder as is
+                return match.group()
+            # The cache store gives us a byte string. Decode that to 'utf-8' and convert to a string
+            return str(value.decode(encoding))
         message = re.sub(pattern, replace_function, message)
         if has_options is True:
             message += '\n'
@@ -52,24 +112,44 @@ class ChatBotUser():
 
 
     def process_message(self, message, initial_state, user):
+        # The funnel counters of all the transitions of a message are written at once
+        self.events = self.funnel.batch() if self.funnel is not None else None
+        try:
+            return self.transition(message, initial_state, user)
+        finally:
+            if self.events is not None:
+                self.events.flush()
+            self.events = None
+
+
+    def transition(self, message, initial_state, user):
         self.state = initial_state
         
         print(f"At state {self.state}, received {message}")
         
         node = self.content['node'][initial_state - 1]
+
+        if self.events is not None and ('user' not in node or initial_state == 1):
+            # A node waiting for an answer was visited when it was prompted (below)
+            self.events.visit(self.name, node.get('id'), self.session_id)
         
         self.has_options = False
 
         # The type of the reply from the Chatbot (text, button, etc)
         self.msg_type = None
 
-        if 'store' in node:
-            key = node['store']
-            self.redis_connection.set(key, message)
-
         if 'options' in node:
             self.has_options = True
 
+        if 'store' in node:
+            key = node['store']
+            if self.has_options is True:
+                # Store the option the answer stands for ('audi r8' is 'Audi R8')
+                idx = self.template.matchers[initial_state - 1].match(message)
+                if idx is not None:
+                    message = node['options'][idx]
+            self.cache.hset(variables_key(self.room_name), key, message)
+
         msg = None
 
         if 'message' in node:
@@ -95,18 +175,22 @@ class ChatBotUser():
                 print('Received user input!')
                 next_state = None
                 if self.has_options is True:
-                    for idx, option in enumerate(node['options']):
-                        if option == message:
-                            print(f"Selected option {option}!")
-                            if isinstance(node['trigger'], list):
-                                next_state = self.hashmap[node['trigger'][idx]]
-                            else:
-                                next_state = self.hashmap[node['trigger']]
-                            self.state = next_state
-                            print(f"next_state = {next_state}")
+                    idx = self.template.matchers[initial_state - 1].match(message)
+                    if idx is not None:
+                        print(f"Selected option {node['options'][idx]}!")
+                        if self.events is not None:
+                            self.events.option(self.name, node.get('id'), idx)
+                        if isinstance(node['trigger'], list):
+                            next_state = self.hashmap[node['trigger'][idx]]
+                        else:
+                            next_state = self.hashmap[node['trigger']]
+                        self.state = next_state
+                        print(f"next_state = {next_state}")
                     if next_state == None:
                         # User has entered a bogus option
                         # Remain in the same state, but indicate error
+                        if self.events is not None:
+                            self.events.error(self.name, node.get('id'))
                         return self.handle_error(message), initial_state, self.msg_type
 
 
@@ -124,6 +208,9 @@ class ChatBotUser():
                 # Check if the next node needs user input
                 next_node = self.content['node'][next_state - 1]
                 if 'user' in next_node:
+                    if self.events is not None:
+                        # The node is prompted now, whether or not it gets answered
+                        self.events.visit(self.name, next_node.get('id'), self.session_id)
                     if 'message' in next_node:
                         msg += '\n' + next_node['message']
                     if 'options' in next_node:
@@ -138,7 +225,7 @@ class ChatBotUser():
             if 'message' in node:
                 return msg, next_state, self.msg_type
             else:
-                return self.process_message(msg, next_state, user), next_state, self.msg_type
+                return self.transition(msg, next_state, user), next_state, self.msg_type
         else:
             pass
     
@@ -0,0 +1,249 @@
+"""
+chatbox/conf.py
+
+Lazy configuration, the connection pool of the Redis store, and the cache store.
+
+Nothing happens when this module is imported. The `.env` file is read on the
+first access to a setting (`config.RETENTION_DAYS`), the connection pool is
+created on the first call to `get_redis()`, and the cache store on the first
+call to `get_cache()`. Environment variables take
+precedence over the `.env` file.
+"""
+
+import os
+import ipaddress
+from threading import Lock
+
+from decouple import Config, RepositoryEnv, Csv, undefined
+
+# The root of the project
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DOTENV_FILE = os.path.join(BASE_DIR, 'chatbox_socketio', '.env')
+
+
+def parse_room_days(value):
+    """
+        Parses per-room retention periods, given as 'room:days,room:days'
+    """
+    room_days = dict()
+    for item in value.split(','):
+        if item.strip() == '':
+            continue
+        room_name, days = item.rsplit(':', 1)
+        room_days[room_name.strip()] = int(days)
+    return room_days
+
+
+def parse_networks(value):
+    """
+        Parses addresses and networks, given as '10.0.0.1,172.16.0.0/12'
+    """
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in value.split(',') if item.strip() != '']
+
+
+def optional(cast):
+    """
+        Casts a setting which may be left unset
+    """
+    return lambda value: None if value is None else cast(value)
+
+
+# Name -> (default, cast). A callable default is only evaluated if the setting is unset
+SETTINGS = {
+    # Redis Server Options
+    'REDIS_SERVER_HOST': (undefined, str),
+    'REDIS_SERVER_PORT': (6379, int),
+    'REDIS_SERVER_PASSWORD': (None, optional(str)),
+
+    # The cache store of the live sessions ('redis', or 'local' for a single worker without a
+    # Redis store, see chatbox/cache.py), with the memory cap, key cap and default TTL (in
+    # seconds, 0 for none) of the local store
+    'CACHE_BACKEND': ('redis', str),
+    'CACHE_LOCAL_MAX_BYTES': (64 * 1024 * 1024, int),
+    'CACHE_LOCAL_MAX_KEYS': (100000, int),
+    'CACHE_LOCAL_TTL': (0, int),
+
+    # Give every visitor of a room a conversation of its own (see chatbox/conversations.py),
+    # rather than sharing the room with every other visitor
+    'VISITOR_CONVERSATIONS': (True, bool),
+
+    # Echo the messages of the visitors back to the room
+    'CHATBOX_DEMO_APPLICATION': (False, bool),
+
+    # Minimum interval (in seconds) between two dashboard updates for a room
+    'DASHBOARD_INTERVAL': (1.0, float),
+
+    # Token bucket limits (tokens per second, burst) for every socket, room and remote address.
+    # A rate of 0 disables the limit for that subject
+    'RATELIMIT_SID_RATE': (1.0, float),
+    'RATELIMIT_SID_BURST': (10, int),
+    'RATELIMIT_ROOM_RATE': (5.0, float),
+    'RATELIMIT_ROOM_BURST': (30, int),
+    'RATELIMIT_ADDR_RATE': (5.0, float),
+    'RATELIMIT_ADDR_BURST': (50, int),
+    # The cost of the messages which do some heavy lifting ('dbupdate', 'admin')
+    'RATELIMIT_EXPENSIVE_COST': (5, int),
+    # What to do with an over-limit message: 'drop' it, or 'defer' it for at most
+    # RATELIMIT_MAX_DEFER seconds before dropping it
+    'RATELIMIT_POLICY': ('drop', str),
+    'RATELIMIT_MAX_DEFER': (2.0, float),
+
+    # The reverse proxies (addresses or networks) whose X-Forwarded-For header is honoured.
+    # The remote address of the other clients is their REMOTE_ADDR
+    'TRUSTED_PROXIES': ('', parse_networks),
+
+    # The serializer of the socket.io packets ('default' for JSON, or 'msgpack')
+    'SOCKETIO_SERIALIZER': ('default', str),
+    # Send the chat events with the short-key payload schema (see chatbox/wire.py)
+    'WIRE_COMPACT_PAYLOADS': (False, bool),
+
+    # The transports offered to the clients. Use 'websocket' to skip the long-polling handshake
+    'SOCKETIO_TRANSPORTS': ('polling,websocket', Csv()),
+    # Heartbeat and buffer settings. These are left to the engine.io defaults when unset
+    'SOCKETIO_PING_INTERVAL': (None, optional(float)),
+    'SOCKETIO_PING_TIMEOUT': (None, optional(float)),
+    'SOCKETIO_MAX_HTTP_BUFFER_SIZE': (None, optional(int)),
+
+    # The archive backend for the flushed sessions ('orm' or 'segment', see chatbox/archive.py)
+    'ARCHIVE_BACKEND': ('orm', str),
+    'ARCHIVE_DIR': (lambda: os.path.join(BASE_DIR, 'archive'), str),
+
+    # Retention of the archive: the default number of days to keep, per-room overrides
+    # ('room:days,room:days'), the size of a delete batch, and the interval (in seconds)
+    # of the background retention task (0 to only run it with `manage.py prune_chat_archive`)
+    'RETENTION_DAYS': (30, int),
+    'RETENTION_ROOM_DAYS': ('', parse_room_days),
+    'RETENTION_BATCH_SIZE': (500, int),
+    'RETENTION_INTERVAL': (0, int),
+
+    # The full-text search index over the archive, for the admins
+    'SEARCH_ENABLED': (True, bool),
+    'SEARCH_INDEX_PATH': (lambda: os.path.join(BASE_DIR, 'search.sqlite3'), str),
+
+    # Funnel analytics of the template chatbots, and how long (in seconds) to keep the
+    # per-minute counters
+    'FUNNEL_ENABLED': (True, bool),
+    'FUNNEL_MINUTE_TTL': (2 * 24 * 60 * 60, int),
+
+    # Rooms idle for more than SESSION_IDLE_TIMEOUT seconds are archived and flushed from the
+    # cache, checking every REAPER_INTERVAL seconds, and reaping at most REAPER_BATCH_SIZE
+    # rooms per check
+    'SESSION_IDLE_TIMEOUT': (30 * 60, int),
+    'REAPER_INTERVAL': (60, int),
+    'REAPER_BATCH_SIZE': (20, int),
+
+    # Free-text answers to the options of the template chatbots (see chatbox/matching.py): the
+    # shortest prefix naming an option, and the share of the words of an option an answer must
+    # contain (0 to disable either)
+    'MATCH_MIN_PREFIX': (1, int),
+    'MATCH_TOKEN_THRESHOLD': (0.5, float),
+
+    # Maximum number of members in a room (0 for no cap), and how long (in seconds) a member
+    # outlives the last heartbeat of its worker (0 for ever)
+    'ROOM_CAPACITY': (0, int),
+    'PRESENCE_TTL': (90, int),
+
+    # Record the socket traffic of every worker to a trace in TRACE_DIR, for `manage.py replay_trace`
+    'TRACE_ENABLED': (False, bool),
+    'TRACE_DIR': (lambda: os.path.join(BASE_DIR, 'traces'), str),
+
+    # On-demand profiling (see chatbox/profiling.py): where to write the reports, how often
+    # (in seconds) the workers check for a profiling window (0 to only profile the worker
+    # serving the request), the interval of the stack sampler, and the longest window
+    'PROFILE_DIR': (lambda: os.path.join(BASE_DIR, 'profiles'), str),
+    'PROFILE_POLL_INTERVAL': (5, int),
+    'PROFILE_STACK_INTERVAL': (0.005, float),
+    'PROFILE_MAX_DURATION': (600, int),
+
+    # Draining on shutdown: the time (in seconds) to archive every live room of the worker,
+    # the number of rooms archived in a single bulk batch, and the number of parallel batches
+    'DRAIN_DEADLINE': (20.0, float),
+    'DRAIN_BATCH_ROOMS': (50, int),
+    'DRAIN_WORKERS': (4, int),
+}
+
+
+class LazyConfig():
+    """
+        Reads the settings on first access, and caches them
+    """
+    def __init__(self, path):
+        self.path = path
+        self.repository = None
+        self.lock = Lock()
+
+
+    def __getattr__(self, name):
+        if name not in SETTINGS:
+            raise AttributeError(f"Unknown setting {name}")
+        with self.lock:
+            if self.repository is None:
+                self.repository = Config(RepositoryEnv(self.path))
+        default, cast = SETTINGS[name]
+        if callable(default):
+            default = default()
+        value = self.repository.get(name, default=default, cast=cast)
+        # Cache it, so that __getattr__ is not called again for this setting
+        setattr(self, name, value)
+        return value
+
+
+    def reset(self):
+        """
+            Forgets the settings, so that they are read again on next access
+        """
+        for name in SETTINGS:
+            self.__dict__.pop(name, None)
+        self.repository = None
+
+
+config = LazyConfig(DOTENV_FILE)
+
+# The connection pool of the Redis store, created on first use
+REDIS_CONNECTION = None
+REDIS_LOCK = Lock()
+
+
+def get_redis():
+    """
+        Gets the connection to the Redis store, creating its pool if necessary
+    """
+    global REDIS_CONNECTION
+    if REDIS_CONNECTION is None:
+        # Imported here, so that importing this module stays cheap
+        from redis import StrictRedis, ConnectionPool
+        with REDIS_LOCK:
+            if REDIS_CONNECTION is None:
+                pool = ConnectionPool(
+                    host=config.REDIS_SERVER_HOST,
+                    port=config.REDIS_SERVER_PORT,
+                    password=config.REDIS_SERVER_PASSWORD,
+                )
+                REDIS_CONNECTION = StrictRedis(connection_pool=pool)
+    return REDIS_CONNECTION
+
+
+# The cache store of the live sessions, created on first use
+CACHE = None
+CACHE_LOCK = Lock()
+
+
+def get_cache():
+    """
+        Gets the cache store of the live sessions, creating it if necessary
+    """
+    global CACHE
+    if CACHE is None:
+        from .cache import CACHE_STORES
+        with CACHE_LOCK:
+            if CACHE is None:
+                if config.CACHE_BACKEND == 'local':
+                    CACHE = CACHE_STORES['local'](
+                        max_bytes=config.CACHE_LOCAL_MAX_BYTES,
+                        max_keys=config.CACHE_LOCAL_MAX_KEYS,
+                        default_ttl=config.CACHE_LOCAL_TTL,
+                    )
+                else:
+                    CACHE = CACHE_STORES['redis'](get_redis())
+    return CACHE
@@ -0,0 +1,45 @@
+"""
+chatbox/conversations.py
+
+Per-visitor conversations under a chatbot room.
+
+Every visitor of a room (e.g. `lobby`) gets a conversation of its own, named
+`<room>~<visitor>`. A conversation is a chat room of its own everywhere
+downstream: its message count, cached messages, history, archive and ChatRoom
+row are keyed by its name. The visitors of a popular room therefore never share
+a hot key, and the bot replies only go to their visitor.
+
+The room still decides the chatbot, the occupancy cap (presence) and the
+per-room retention overrides.
+"""
+
+import re
+
+CONVERSATION_SEPARATOR = '~'
+
+# The visitor ids sent by the clients (a random id kept by the browser)
+VISITOR_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+
+def conversation_name(room_name, visitor):
+    return f"{room_name}{CONVERSATION_SEPARATOR}{visitor}"
+
+
+def conversation_prefix(room_name):
+    return f"{room_name}{CONVERSATION_SEPARATOR}"
+
+
+def base_room(chat_room):
+    """
+        The room of a conversation (or the room itself)
+    """
+    return chat_room.split(CONVERSATION_SEPARATOR, 1)[0]
+
+
+def visitor_id(visitor, sid):
+    """
+        The visitor id sent by the client, falling back to the sid of its socket
+    """
+    if isinstance(visitor, str) and VISITOR_PATTERN.match(visitor):
+        return visitor
+    return sid
@@ -0,0 +1,241 @@
+"""
+chatbox/dashboard.py
+
+Fans in the activity of every room for the admin dashboard.
+
+Each worker publishes a compact summary of every cached message on a single
+Redis pub/sub channel. One relay per worker subscribes to that channel, and
+pushes coalesced, rate-limited per-room updates to the admin sockets watching
+the dashboard. An admin socket therefore never needs to join every room.
+`LocalDashboardRelay` hands the summaries straight to the relay instead, for the
+deployments without a Redis store (see `CACHE_BACKEND=local`).
+"""
+
+import json
+import time
+from threading import Lock, Thread
+
+from .conversations import base_room
+
+# The pub/sub channel on which every worker publishes room activity
+DASHBOARD_CHANNEL = 'DASHBOARD_ACTIVITY'
+
+# Hashes holding the latest summary of a room and of its conversations, used for the initial snapshot
+DASHBOARD_SNAPSHOT = 'DASHBOARD_SNAPSHOT'
+
+# Set of the rooms which have a snapshot hash, for the admins watching every room
+DASHBOARD_SNAPSHOT_ROOMS = 'DASHBOARD_SNAPSHOT_ROOMS'
+
+# The socket.io room for admins watching every room
+DASHBOARD_ROOM = 'dashboard'
+
+# Length of the message preview sent in a summary
+PREVIEW_LENGTH = 80
+
+# How long (in seconds) the relay blocks on the dashboard channel, waiting for a summary
+LISTEN_TIMEOUT = 1.0
+
+
+def dashboard_room(room_name):
+    """
+        The socket.io room for admins watching only `room_name`
+    """
+    return f"dashboard_{room_name}"
+
+
+def snapshot_key(room_name):
+    """
+        The snapshot hash of a room, shared by its conversations
+    """
+    return f"{DASHBOARD_SNAPSHOT}_{base_room(room_name)}"
+
+
+def summarize(room_name, content):
+    """
+        Builds the compact summary of a cached message
+    """
+    return {
+        'room': room_name,
+        'msg_num': int(content['msg_num']),
+        'user': content['user_name'],
+        'preview': content['message'][:PREVIEW_LENGTH],
+        'ts': round(time.time(), 3),
+    }
+
+
+def publish_activity(redis_connection, room_name, content):
+    """
+        Publishes the summary of a message to every worker, in one round trip
+    """
+    summary = json.dumps(summarize(room_name, content))
+    with redis_connection.pipeline(transaction=False) as pipe:
+        pipe.hset(snapshot_key(room_name), room_name, summary)
+        pipe.sadd(DASHBOARD_SNAPSHOT_ROOMS, base_room(room_name))
+        pipe.publish(DASHBOARD_CHANNEL, summary)
+        pipe.execute()
+
+
+def forget_room(redis_connection, room_name):
+    """
+        Drops the summary of a room which has been purged from the cache
+    """
+    redis_connection.hdel(snapshot_key(room_name), room_name)
+
+
+def fetch_snapshot(redis_connection, rooms=None):
+    """
+        Gets the latest summary for `rooms` and their conversations, or for every room if `rooms` is None.
+        Only the hashes of the requested rooms are read, in one round trip.
+    """
+    if rooms is None:
+        rooms = [room_name.decode('utf-8') for room_name in redis_connection.smembers(DASHBOARD_SNAPSHOT_ROOMS)]
+    if not rooms:
+        return []
+    with redis_connection.pipeline(transaction=False) as pipe:
+        for room_name in rooms:
+            if base_room(room_name) == room_name:
+                # The room, and its conversations
+                pipe.hgetall(snapshot_key(room_name))
+            else:
+                pipe.hget(snapshot_key(room_name), room_name)
+        results = pipe.execute()
+    snapshot = dict()
+    for room_name, result in zip(rooms, results):
+        if isinstance(result, dict):
+            for key, value in result.items():
+                snapshot[key.decode('utf-8')] = value
+        elif result is not None:
+            snapshot[room_name] = result
+    return [json.loads(value.decode('utf-8')) for value in snapshot.values()]
+
+
+class DashboardRelay():
+    """
+        Relays the dashboard channel to the admin sockets of this worker.
+
+        Summaries are coalesced per room, and flushed at most once every
+        `interval` seconds, so a busy room costs one emit per interval.
+    """
+    def __init__(self, redis_connection, namespace='/admin', interval=1.0):
+        self.redis_connection = redis_connection
+        self.namespace = namespace
+        self.interval = interval
+        self.pending = dict()
+        self.lock = Lock()
+        self.started = False
+
+
+    def start(self, server):
+        """
+            Starts the subscriber and the flusher, once per worker
+        """
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        # A thread of its own, which may block on the channel: a green thread once monkey-patched,
+        # and an OS thread otherwise, so that it never blocks the eventlet hub either way
+        Thread(target=self.listen, daemon=True).start()
+        server.start_background_task(self.flush, server)
+
+
+    def publish(self, room_name, content):
+        publish_activity(self.redis_connection, room_name, content)
+
+
+    def forget(self, room_name):
+        forget_room(self.redis_connection, room_name)
+
+
+    def snapshot(self, rooms=None):
+        return fetch_snapshot(self.redis_connection, rooms)
+
+
+    def coalesce(self, summary):
+        with self.lock:
+            previous = self.pending.get(summary['room'])
+            summary['count'] = 1 if previous is None else previous['count'] + 1
+            self.pending[summary['room']] = summary
+
+
+    def listen(self):
+        """
+            Subscribes to the dashboard channel and coalesces summaries per room.
+            The relay blocks on the channel until a summary comes in, for at most
+            `LISTEN_TIMEOUT` seconds at a time.
+        """
+        pubsub = self.redis_connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(DASHBOARD_CHANNEL)
+        while True:
+            item = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+            if item is None or item['type'] != 'message':
+                continue
+            self.coalesce(json.loads(item['data'].decode('utf-8')))
+
+
+    def flush(self, server):
+        """
+            Emits the coalesced summaries to the dashboard rooms
+        """
+        while True:
+            server.sleep(self.interval)
+            with self.lock:
+                pending, self.pending = self.pending, dict()
+            for room_name, summary in pending.items():
+                server.emit('room_activity', summary, room=DASHBOARD_ROOM,
+                            namespace=self.namespace)
+                server.emit('room_activity', summary, room=dashboard_room(room_name),
+                            namespace=self.namespace)
+                if base_room(room_name) != room_name:
+                    # The admins watching the room of a conversation
+                    server.emit('room_activity', summary, room=dashboard_room(base_room(room_name)),
+                                namespace=self.namespace)
+
+
+class LocalDashboardRelay(DashboardRelay):
+    """
+        Relays the activity of the rooms of this process, without a pub/sub channel
+    """
+    def __init__(self, namespace='/admin', interval=1.0):
+        super().__init__(None, namespace, interval)
+        # Room -> {room or conversation -> latest summary}
+        self.summaries = dict()
+
+
+    def start(self, server):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        server.start_background_task(self.flush, server)
+
+
+    def publish(self, room_name, content):
+        summary = summarize(room_name, content)
+        with self.lock:
+            self.summaries.setdefault(base_room(room_name), dict())[room_name] = summary
+        if self.started:
+            self.coalesce(dict(summary))
+
+
+    def forget(self, room_name):
+        with self.lock:
+            summaries = self.summaries.get(base_room(room_name), dict())
+            summaries.pop(room_name, None)
+            if not summaries:
+                self.summaries.pop(base_room(room_name), None)
+
+
+    def snapshot(self, rooms=None):
+        with self.lock:
+            if rooms is None:
+                rooms = list(self.summaries)
+            snapshot = dict()
+            for room_name in rooms:
+                summaries = self.summaries.get(base_room(room_name), dict())
+                if base_room(room_name) == room_name:
+                    # The room, and its conversations
+                    snapshot.update(summaries)
+                elif room_name in summaries:
+                    snapshot[room_name] = summaries[room_name]
+            return list(snapshot.values())
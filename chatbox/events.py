@@ -8,41 +8,75 @@ and uses a Redis Store as a temporary cache for a persistent DB.
 """
 
 import os
-from itertools import zip_longest
+import time
+import signal
+import ipaddress
+import secrets
+from http.cookies import SimpleCookie
+from importlib import import_module
+from concurrent.futures import ThreadPoolExecutor, wait
 from threading import Event # Wait for an event to occur
 
+from django.conf import settings
+from django.contrib import auth
 from django.db import transaction, IntegrityError
-from decouple import Config, RepositoryEnv, UndefinedValueError
-from redis import StrictRedis, WatchError
+from django.http import HttpRequest
+from redis import WatchError
 import socketio
 
-from .chatbot import room_to_chatbot_user, ChatBotUser
-from .serializers import ChatBoxMessageSerializer
+from .conf import config, get_redis, get_cache
+from .chatbot import room_to_chatbot_user, ChatBotUser, template_path, variables_key
+from .analytics import FunnelRecorder, LocalFunnelRecorder
+from .reaper import IdleRoomClaimer, LocalIdleRoomClaimer
+from .presence import Presence, LocalPresence, presence_member
+from .conversations import conversation_name, base_room, visitor_id
+from .dashboard import DashboardRelay, LocalDashboardRelay, dashboard_room, DASHBOARD_ROOM
+from .ratelimit import RateLimiter, LocalRateLimiter
+from .wire import compact_payload, client_options, check_serializer
+from .records import (messages_key, meta_key, history_key, room_fields, pack_message,
+                      unpack_message, pack_history, unpack_history, decode_fields)
+from .archive import ARCHIVE_BACKENDS
+from .search import SearchIndex
+from .trace import TraceRecorder, template_options
+from .profiling import HandlerProfiler, read_control
+from .retention import apply_retention, prune_segments
 from .models import ChatRoom
 
-# Redis Server Options
-DOTENV_FILE = os.path.join(os.getcwd(), 'chatbox_socketio', '.env')
-env_config = Config(RepositoryEnv(DOTENV_FILE))
+# The dashboard relay of this worker. This is created on the first dashboard subscription
+DASHBOARD_RELAY = None
 
-HOST = env_config.get('REDIS_SERVER_HOST')
+# The rate limiter, created on first use
+RATE_LIMITER = None
 
-try:
-    PASSWORD = env_config.get('REDIS_SERVER_PASSWORD')
-except UndefinedValueError:
-    PASSWORD = None
+# Messages which cost more than a single token, since they do some heavy lifting
+EXPENSIVE_MESSAGES = ('dbupdate', 'admin')
 
-PORT = env_config.get('REDIS_SERVER_PORT')
+# The archive backend, created on first use
+ARCHIVE = None
 
-if PASSWORD is None:
-    REDIS_CONNECTION = StrictRedis(host=HOST, port=PORT)
-else:
-    REDIS_CONNECTION = StrictRedis(host=HOST, password=PASSWORD, port=PORT)
+# The search index, created on first use
+SEARCH_INDEX = None
 
-try:
-    CHATBOX_DEMO_APPLICATION = env_config.get('CHATBOX_DEMO_APPLICATION', cast=bool)
-except UndefinedValueError:
-    CHATBOX_DEMO_APPLICATION = False
+# The funnel recorder, created on first use
+FUNNEL_RECORDER = None
 
+# The presence tracker, created on first use
+PRESENCE = None
+
+# The tracker of the idle rooms, created on first use
+IDLE_CLAIMER = None
+
+# The trace recorder of this worker, created on first use when tracing is enabled
+TRACE_RECORDER = None
+
+# The handler profiler of this worker, created on first use
+PROFILER = None
+
+# Set when the worker is draining. New connections are refused from then on
+DRAINING = False
+
+# Set once the background tasks of this worker have been started
+BACKGROUND_TASKS_STARTED = False
 
 # The event object, which the background thread waits on. Update the DB when the event is set
 event = Event()
@@ -50,6 +84,9 @@ event = Event()
 # Store the last N messages for the recent history
 N = 5
 
+# How long (in seconds) a visitor handed over to the livechat may join its conversation
+LIVECHAT_GRANT_TTL = 5 * 60
+
 def get_user():
     """
         Gets the user related credentials from the client side
@@ -58,32 +95,64 @@ def get_user():
     return 'AnonymousUser'
 
 
-def fetch_redis_batch(redis_iterable, batch_size):
+def get_session_user(environ):
     """
-        Get a batch of keys from the redis store, as a list of iterators
+        Gets the Django user of a socket, from the session cookie of its handshake
     """
-    # Fetch all the keys and values in a batch
-    keys = [iter(redis_iterable)] * batch_size
-    return zip_longest(*keys)
+    morsel = SimpleCookie(environ.get('HTTP_COOKIE', '')).get(settings.SESSION_COOKIE_NAME)
+    request = HttpRequest()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(
+        None if morsel is None else morsel.value
+    )
+    # An anonymous user without a session
+    return auth.get_user(request)
 
 
-def fetch_recent_history(room_name):
+def is_staff(user):
+    return user.is_authenticated and (user.is_staff or user.is_superuser)
+
+
+def grant_livechat(conversation):
     """
-        Get last history msgs from redis
+        Lets the visitor of a conversation join it on the admin namespace, for a while.
+        Returns the token of the grant.
     """
-    global REDIS_CONNECTION
-    msgs = []
+    token = secrets.token_urlsafe(16)
+    get_cache().set(f"LIVECHAT_{token}", conversation, ex=LIVECHAT_GRANT_TTL)
+    return token
 
-    # TODO: Optimize this function
-    for key in REDIS_CONNECTION.scan_iter(f"HISTORY_{room_name}_*"):
-        if key is None:
-            break
-        content = REDIS_CONNECTION.hgetall(key)
-        content = {key.decode('utf-8'): value.decode('utf-8') for key, value in content.items()}
-        msgs.append(content)
+
+def has_livechat_grant(token, conversation):
+    if not isinstance(token, str):
+        return False
+    granted = get_cache().get(f"LIVECHAT_{token}")
+    return granted is not None and granted.decode('utf-8') == conversation
+
+
+def fetch_recent_history(room_name):
+    """
+        Get last history msgs from redis, oldest first
+    """
+    msgs = [unpack_history(packed) for packed in get_cache().lrange(history_key(room_name), 0, N)]
+    msgs.reverse()
     return msgs
 
 
+def fetch_cached_messages(room_name, batch_size):
+    """
+        Get the messages of a session from the redis cache, as batches of dicts
+    """
+    fields = decode_fields(get_cache().hgetall(meta_key(room_name)))
+    batch = []
+    for msg_num, packed in get_cache().hscan_iter(messages_key(room_name), count=batch_size):
+        batch.append(unpack_message(msg_num.decode('utf-8'), packed, fields))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch != []:
+        yield batch
+
+
 def get_last_state_from_redis(room_name):
     """
         Get the most recent state from the redis store
@@ -92,61 +161,312 @@ def get_last_state_from_redis(room_name):
     return 1
 
 
-def flush_session(room_name, batch_size):
+def flush_session(room_name):
     """
         Deletes the messages related to the session on the redis cache
     """
     # Flush the contents of the redis cache for this session
-    global REDIS_CONNECTION
-    for key_batch in fetch_redis_batch(
-            REDIS_CONNECTION.scan_iter(f"{room_name}_*"), batch_size
-        ):
-        for key in key_batch:
-            if key is None:
-                break
-            REDIS_CONNECTION.delete(key)
+    get_cache().delete(messages_key(room_name), meta_key(room_name))
 
 
 def update_session_redis(room_name, msg_number, content):
     """
         Sets the key-value fields for a message on the redis store
     """
-    global REDIS_CONNECTION
-    REDIS_CONNECTION.hmset(room_name + "_" + str(msg_number), content)
-    # Also update the history
-    # TODO: Store it as a single nested hash value
-    REDIS_CONNECTION.hmset(f"HISTORY_{room_name}_{msg_number % (N + 1)}", content)
+    with get_cache().pipeline(transaction=False) as pipe:
+        pipe.hmset(meta_key(room_name), room_fields(content))
+        pipe.hset(messages_key(room_name), msg_number, pack_message(content))
+        # Also update the history, keeping only the last N + 1 messages
+        pipe.lpush(history_key(room_name), pack_history(content))
+        pipe.ltrim(history_key(room_name), 0, N)
+        pipe.execute()
+    # Let the admin dashboards know about this message
+    get_dashboard_relay().publish(room_name, content)
+
+
+def local_backend():
+    """
+        Whether this worker runs without a Redis store, keeping its state in memory
+    """
+    return config.CACHE_BACKEND == 'local'
+
+
+def get_archive_backend():
+    """
+        Gets the archive backend, creating it if necessary
+    """
+    global ARCHIVE
+    if ARCHIVE is None:
+        if config.ARCHIVE_BACKEND == 'segment':
+            ARCHIVE = ARCHIVE_BACKENDS['segment'](config.ARCHIVE_DIR)
+        else:
+            ARCHIVE = ARCHIVE_BACKENDS[config.ARCHIVE_BACKEND]()
+    return ARCHIVE
+
+
+def get_search_index():
+    """
+        Gets the search index, creating it if necessary
+    """
+    global SEARCH_INDEX
+    if SEARCH_INDEX is None:
+        SEARCH_INDEX = SearchIndex(config.SEARCH_INDEX_PATH)
+    return SEARCH_INDEX
+
+
+def get_funnel_recorder():
+    """
+        Gets the funnel recorder, creating it if necessary. This is None if the analytics are disabled.
+    """
+    global FUNNEL_RECORDER
+    if config.FUNNEL_ENABLED and FUNNEL_RECORDER is None:
+        if local_backend():
+            FUNNEL_RECORDER = LocalFunnelRecorder(config.FUNNEL_MINUTE_TTL)
+        else:
+            FUNNEL_RECORDER = FunnelRecorder(get_redis(), config.FUNNEL_MINUTE_TTL)
+    return FUNNEL_RECORDER
+
+
+def get_presence():
+    """
+        Gets the presence tracker, creating it if necessary
+    """
+    global PRESENCE
+    if PRESENCE is None:
+        if local_backend():
+            PRESENCE = LocalPresence(config.ROOM_CAPACITY, config.PRESENCE_TTL)
+        else:
+            PRESENCE = Presence(get_redis(), config.ROOM_CAPACITY, config.PRESENCE_TTL)
+    return PRESENCE
+
+
+def join_presence(namespace, sid, conversation):
+    """
+        Adds a socket to the members of the room of a conversation, under its occupancy cap,
+        and to those of the conversation itself, which the reaper checks. Returns False if the room is full.
+    """
+    member = presence_member(namespace, sid)
+    if not get_presence().join(base_room(conversation), member):
+        return False
+    if conversation != base_room(conversation):
+        get_presence().join(conversation, member, capacity=0)
+    return True
+
+
+def leave_presence(namespace, sid, conversation):
+    """
+        Removes a socket from the members of a conversation, and of its room
+    """
+    member = presence_member(namespace, sid)
+    get_presence().leave(base_room(conversation), member)
+    if conversation != base_room(conversation):
+        get_presence().leave(conversation, member)
+
+
+def get_idle_claimer():
+    """
+        Gets the tracker of the idle rooms, creating it if necessary
+    """
+    global IDLE_CLAIMER
+    if IDLE_CLAIMER is None:
+        if local_backend():
+            IDLE_CLAIMER = LocalIdleRoomClaimer(config.SESSION_IDLE_TIMEOUT)
+        else:
+            IDLE_CLAIMER = IdleRoomClaimer(get_redis(), config.SESSION_IDLE_TIMEOUT)
+    return IDLE_CLAIMER
+
+
+def get_trace_recorder():
+    """
+        Gets the trace recorder of this worker, creating it if necessary.
+        Returns None when tracing is disabled.
+    """
+    global TRACE_RECORDER
+    if config.TRACE_ENABLED and TRACE_RECORDER is None:
+        path = os.path.join(config.TRACE_DIR, f"trace-{os.getpid()}-{int(time.time())}.msgpack")
+        TRACE_RECORDER = TraceRecorder(
+            path,
+            keep=template_options(os.path.dirname(template_path('default'))) | set(EXPENSIVE_MESSAGES),
+            rooms=room_to_chatbot_user.keys(),
+        )
+        print(f"Recording the socket traffic to {path}")
+    return TRACE_RECORDER
+
+
+def get_profiler():
+    """
+        Gets the handler profiler of this worker, creating it if necessary
+    """
+    global PROFILER
+    if PROFILER is None:
+        PROFILER = HandlerProfiler(config.PROFILE_DIR, config.PROFILE_STACK_INTERVAL)
+    return PROFILER
+
+
+def apply_profile_control(control):
+    """
+        Starts or stops the profiling session of this worker, as per the window requested by the admins
+    """
+    profiler = get_profiler()
+    now = time.time()
+    if control is not None and control['until'] > now and control['session'] != profiler.session:
+        profiler.start(control['session'], control['sample_rate'], control['until'])
+    elif profiler.session is not None and (
+            control is None or control['session'] != profiler.session or control['until'] <= now
+            or profiler.until <= now):
+        profiler.stop()
+
+
+def fetch_archived_history(room_name, room_id):
+    """
+        Get the last history msgs from the archive, oldest first
+    """
+    return get_archive_backend().read_recent(room_name, room_id, N + 1)
 
 
 def update_session_db(room_name):
     """
-        Updates the database with the session data from the stored cache in redis
+        Updates the archive with the session data from the stored cache in redis
     """
-    global REDIS_CONNECTION
+    get_profiler().call('events:update_session_db', write_session_db, room_name)
 
-    # TODO: Eliminate this inefficient scanning and do something much better
-    for key_batch in fetch_redis_batch(REDIS_CONNECTION.scan_iter(room_name + '_*'), 500):
-        for key in key_batch:
-            if key is None:
-                break
-            content = REDIS_CONNECTION.hgetall(key)
-            content = {key.decode('utf-8'): value.decode('utf-8') for key, value in content.items()}
 
-            #if isinstance(content['room_id'], uuid.UUID):
-            #    content['room_id'] = uuid.UUID(content['room_id'])
+def write_session_db(room_name):
+    """
+        Writes the cached messages of a session to the archive, batch by batch
+    """
+    backend = get_archive_backend()
+    for batch in fetch_cached_messages(room_name, 500):
+        backend.write_batch(room_name, batch)
+        if config.SEARCH_ENABLED:
+            get_search_index().index_batch(batch)
 
-            print(f"Content: {content}")
 
-            # Using a serializer here, as otherwise, getting the instance of
-            # ChatRoom and passing it to the ChatboxMsg instance is painful
-            serializer = ChatBoxMessageSerializer(data=content)
+def archive_rooms(room_names):
+    """
+        Archives then flushes the sessions of many rooms, as a single bulk batch.
+        Returns the number of archived messages.
+    """
+    with get_cache().pipeline(transaction=False) as pipe:
+        for room_name in room_names:
+            pipe.hgetall(meta_key(room_name))
+            pipe.hgetall(messages_key(room_name))
+            pipe.get(f"curr_msg_{room_name}")
+        results = pipe.execute()
 
-            try:
-                if serializer.is_valid():
-                    with transaction.atomic():
-                        serializer.save()
-            except IntegrityError:
-                print('PK for ChatRoomMessage is already there in DB!')
+    msgs = []
+    counts = dict()
+    for idx, room_name in enumerate(room_names):
+        fields, packed_msgs, num_msgs = results[3 * idx:3 * idx + 3]
+        fields = decode_fields(fields)
+        msgs.extend(
+            unpack_message(msg_num.decode('utf-8'), packed, fields)
+            for msg_num, packed in packed_msgs.items()
+        )
+        if num_msgs is not None:
+            counts[room_name] = int(num_msgs)
+
+    if msgs != []:
+        get_archive_backend().write_bulk(msgs)
+        if config.SEARCH_ENABLED:
+            get_search_index().index_batch(msgs)
+    with transaction.atomic():
+        for room_name, num_msgs in counts.items():
+            ChatRoom.objects.filter(room_name=room_name).update(num_msgs=num_msgs)
+
+    with get_cache().pipeline(transaction=False) as pipe:
+        for room_name in room_names:
+            pipe.delete(messages_key(room_name), meta_key(room_name))
+        pipe.execute()
+    return len(msgs)
+
+
+def live_rooms(server, namespaces=('/chat', '/admin')):
+    """
+        Gets the chat rooms with a participant connected to this worker
+    """
+    rooms = set()
+    for namespace in namespaces:
+        for room_name, participants in server.manager.rooms.get(namespace, {}).items():
+            if room_name is None or room_name in participants:
+                # Every socket is in the room of its own sid
+                continue
+            if room_name == DASHBOARD_ROOM or room_name.startswith('dashboard_'):
+                continue
+            rooms.add(room_name)
+    return sorted(rooms)
+
+
+def live_members(server, namespaces=('/chat', '/admin')):
+    """
+        Gets the presence members of the sockets connected to this worker
+    """
+    return [
+        presence_member(namespace, sid)
+        for namespace in namespaces
+        for sid in server.manager.rooms.get(namespace, {}).get(None, {})
+    ]
+
+
+def drain(server, deadline=None):
+    """
+        Drains the worker: refuses new connections, asks the clients to reconnect elsewhere,
+        and archives every live room in parallel bulk batches, until the deadline.
+        Returns (archived rooms, archived messages, rooms left over).
+    """
+    global DRAINING
+    DRAINING = True
+    deadline = config.DRAIN_DEADLINE if deadline is None else deadline
+    start = time.monotonic()
+
+    for namespace in ('/chat', '/admin'):
+        server.emit('reconnect_elsewhere', {'data': "The server is restarting. Reconnecting..."},
+                    namespace=namespace)
+
+    rooms = live_rooms(server)
+    # The sockets are going away with the worker, and must not keep their rooms full
+    try:
+        released = get_presence().release(live_members(server))
+        print(f"Released the presence of {released} sockets")
+    except Exception as ex:
+        print(f"Could not release the presence: {ex}")
+    batches = [rooms[idx:idx + config.DRAIN_BATCH_ROOMS] for idx in range(0, len(rooms), config.DRAIN_BATCH_ROOMS)]
+
+    archived_rooms, archived_msgs = 0, 0
+    executor = ThreadPoolExecutor(max_workers=config.DRAIN_WORKERS)
+    futures = {executor.submit(archive_rooms, batch): batch for batch in batches}
+    done, _ = wait(futures, timeout=max(deadline - (time.monotonic() - start), 0))
+    executor.shutdown(wait=False)
+
+    for future in done:
+        try:
+            archived_msgs += future.result()
+            archived_rooms += len(futures[future])
+        except Exception as ex:
+            print(f"Could not archive rooms {futures[future]}: {ex}")
+
+    left = len(rooms) - archived_rooms
+    if TRACE_RECORDER is not None:
+        TRACE_RECORDER.close()
+    print(f"Drained {archived_rooms} rooms ({archived_msgs} messages) in "
+          f"{time.monotonic() - start:.2f}s. {left} rooms left over")
+    return archived_rooms, archived_msgs, left
+
+
+def install_drain_handler(server, signum=signal.SIGTERM):
+    """
+        Drains the worker on SIGTERM, before handing over to the previous handler
+    """
+    previous = signal.getsignal(signum)
+
+    def handler(received, frame):
+        drain(server)
+        if callable(previous):
+            previous(received, frame)
+        else:
+            raise SystemExit(0)
+
+    signal.signal(signum, handler)
 
 
 def background_handler():
@@ -159,12 +479,156 @@ def background_handler():
         event.clear() # Clear the flag
 
 
+def run_retention():
+    """
+        Applies the retention periods to the archive
+    """
+    search_index = get_search_index() if config.SEARCH_ENABLED else None
+    if config.ARCHIVE_BACKEND == 'segment':
+        return {None: prune_segments(config.ARCHIVE_DIR, config.RETENTION_DAYS, search_index)}
+    return apply_retention(config.RETENTION_DAYS, config.RETENTION_ROOM_DAYS, config.RETENTION_BATCH_SIZE,
+                           search_index=search_index)
+
+
+def purge_session(room_name):
+    """
+        Deletes everything related to the session on the redis cache,
+        including the recent history, the message count and the chatbot variables
+    """
+    flush_session(room_name)
+    get_cache().delete(history_key(room_name), f"curr_msg_{room_name}", variables_key(room_name))
+    get_dashboard_relay().forget(room_name)
+    # The room outlives its conversations. Only drop its expired members, since the other
+    # visitors of the room may still be there.
+    get_presence().prune(base_room(room_name))
+    if room_name != base_room(room_name):
+        get_presence().prune(room_name)
+
+
+def reap_room(room_name):
+    """
+        Archives then flushes an abandoned session
+    """
+    num_msgs, _ = atomic_get(f"curr_msg_{room_name}")
+    if num_msgs is not None:
+        ChatRoom.objects.filter(room_name=room_name).update(num_msgs=int(num_msgs))
+    update_session_db(room_name)
+    purge_session(room_name)
+
+
+def reap_idle_rooms(claimer, batch_size):
+    """
+        Reaps a batch of idle rooms, skipping those which still have members.
+        Returns the number of reaped rooms.
+    """
+    reaped = 0
+    rooms = claimer.claim(batch_size)
+    occupancy = get_presence().occupancy(rooms) if rooms else {}
+    for room_name in rooms:
+        if occupancy[room_name] > 0:
+            # Idle, but somebody is still there: check again after another idle timeout
+            claimer.touch(room_name)
+            continue
+        try:
+            reap_room(room_name)
+            reaped += 1
+        except Exception as ex:
+            # Nothing has been flushed yet, so try again later
+            print(f"Could not reap room {room_name}: {ex}")
+            claimer.release(room_name)
+    return reaped
+
+
+def reaper_handler(server):
+    """
+        The background worker, which periodically reaps the idle rooms
+    """
+    claimer = get_idle_claimer()
+    while True:
+        server.sleep(config.REAPER_INTERVAL)
+        reaped = reap_idle_rooms(claimer, config.REAPER_BATCH_SIZE)
+        if reaped:
+            print(f"Reaped {reaped} idle rooms")
+
+
+def retention_handler(server):
+    """
+        The background worker, which periodically applies the retention periods
+    """
+    while True:
+        server.sleep(config.RETENTION_INTERVAL)
+        try:
+            deleted = run_retention()
+            print(f"Retention: pruned {sum(deleted.values())} messages")
+        except Exception as ex:
+            print(f"Retention failed: {ex}")
+
+
+def presence_handler(server):
+    """
+        The background worker, which keeps the presence of the connected sockets of this worker alive
+    """
+    def connected(member):
+        namespace, sid = member.split(':', 1)
+        return server.manager.is_connected(sid, namespace)
+
+    while True:
+        server.sleep(config.PRESENCE_TTL / 3)
+        try:
+            get_presence().heartbeat(connected)
+        except Exception as ex:
+            print(f"Presence heartbeat failed: {ex}")
+
+
+def profiler_handler(server):
+    """
+        The background worker, which picks up the profiling windows requested by the admins
+    """
+    while True:
+        server.sleep(config.PROFILE_POLL_INTERVAL)
+        try:
+            apply_profile_control(read_control(get_cache()))
+        except Exception as ex:
+            print(f"Profiling control failed: {ex}")
+
+
+def start_background_tasks(server):
+    """
+        Starts the background tasks of this worker, once
+    """
+    global BACKGROUND_TASKS_STARTED
+    if BACKGROUND_TASKS_STARTED:
+        return
+    BACKGROUND_TASKS_STARTED = True
+    if config.RETENTION_INTERVAL > 0:
+        server.start_background_task(retention_handler, server)
+    if config.REAPER_INTERVAL > 0:
+        server.start_background_task(reaper_handler, server)
+    if config.PROFILE_POLL_INTERVAL > 0:
+        server.start_background_task(profiler_handler, server)
+    if config.PRESENCE_TTL > 0:
+        server.start_background_task(presence_handler, server)
+
+
+def start_worker(server):
+    """
+        The startup hook of a worker process: connects to the Redis store (unless the worker
+        runs without one), starts the background tasks and installs the drain handler. Called by
+        the server once the worker is up (see chatbox_socketio/wsgi.py), so that importing this
+        module has no side effects.
+    """
+    if not local_backend():
+        get_redis().ping()
+    get_cache()
+    start_background_tasks(server)
+    install_drain_handler(server)
+
+
 def atomic_set(key, value):
     """
-        Atomically sets {key: value} on the redis store
+        Atomically sets {key: value} on the cache store
     """
-    global REDIS_CONNECTION
-    with REDIS_CONNECTION.pipeline() as pipe:
+    with get_cache().pipeline() as pipe:
         try:
             pipe.watch(key)
             pipe.multi()
@@ -177,10 +641,9 @@ def atomic_set(key, value):
 
 def atomic_get(key):
     """
-        Atomically gets the most recent {key : value} pair from the redis store
+        Atomically gets the most recent {key : value} pair from the cache store
     """
-    global REDIS_CONNECTION
-    with REDIS_CONNECTION.pipeline() as pipe:
+    with get_cache().pipeline() as pipe:
         try:
             pipe.watch(key)
             pipe.multi()
@@ -190,6 +653,126 @@ def atomic_get(key):
             return pipe.get(key), True
 
 
+def socketio_options():
+    """
+        Gets the options of the socket.io server
+    """
+    options = {'transports': config.SOCKETIO_TRANSPORTS}
+    if check_serializer(config.SOCKETIO_SERIALIZER) != 'default':
+        options['serializer'] = config.SOCKETIO_SERIALIZER
+    if config.SOCKETIO_PING_INTERVAL is not None:
+        options['ping_interval'] = float(config.SOCKETIO_PING_INTERVAL)
+    if config.SOCKETIO_PING_TIMEOUT is not None:
+        options['ping_timeout'] = float(config.SOCKETIO_PING_TIMEOUT)
+    if config.SOCKETIO_MAX_HTTP_BUFFER_SIZE is not None:
+        options['max_http_buffer_size'] = int(config.SOCKETIO_MAX_HTTP_BUFFER_SIZE)
+    return options
+
+
+def wire_options():
+    """
+        Gets the wire options for the client, to be passed through the page context
+    """
+    return client_options(check_serializer(config.SOCKETIO_SERIALIZER), config.WIRE_COMPACT_PAYLOADS,
+                          config.SOCKETIO_TRANSPORTS)
+
+
+def chat_payload(payload):
+    """
+        Encodes the payload of a chat event as per the wire options
+    """
+    return compact_payload(payload) if config.WIRE_COMPACT_PAYLOADS else payload
+
+
+def is_trusted_proxy(addr):
+    """
+        Whether an address is one of the TRUSTED_PROXIES
+    """
+    try:
+        address = ipaddress.ip_address(addr)
+    except ValueError:
+        return False
+    return any(address in network for network in config.TRUSTED_PROXIES)
+
+
+def get_remote_addr(environ):
+    """
+        Gets the address of the client from the WSGI environment.
+        X-Forwarded-For can be forged by any client, so it is only honoured for the
+        connections of the TRUSTED_PROXIES: the client is the last hop which is not one of them.
+    """
+    addr = environ.get('REMOTE_ADDR')
+    forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+    if not forwarded or not is_trusted_proxy(addr):
+        return addr
+    hops = [hop.strip() for hop in forwarded.split(',') if hop.strip() != '']
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else addr
+
+
+def get_rate_limiter():
+    """
+        Gets the rate limiter, creating it if necessary
+    """
+    global RATE_LIMITER
+    if RATE_LIMITER is None:
+        limits = {
+            'sid': (config.RATELIMIT_SID_RATE, config.RATELIMIT_SID_BURST),
+            'room': (config.RATELIMIT_ROOM_RATE, config.RATELIMIT_ROOM_BURST),
+            'addr': (config.RATELIMIT_ADDR_RATE, config.RATELIMIT_ADDR_BURST),
+        }
+        if local_backend():
+            RATE_LIMITER = LocalRateLimiter(limits)
+        else:
+            RATE_LIMITER = RateLimiter(get_redis(), limits)
+    return RATE_LIMITER
+
+
+def admit_message(namespace, sid, room_name, msg_content):
+    """
+        Checks a message against the rate limits of its socket, room and address.
+        Over-limit messages are deferred or dropped, as per config.RATELIMIT_POLICY,
+        and the client is told about it with a 'rate_limited' event.
+    """
+    cost = config.RATELIMIT_EXPENSIVE_COST if msg_content in EXPENSIVE_MESSAGES else 1
+    with namespace.session(sid) as session:
+        remote_addr = session.get('remote_addr')
+
+    limiter = get_rate_limiter()
+    retry_after = limiter.acquire(cost, sid=sid, room=room_name, addr=remote_addr)
+
+    if retry_after > 0 and config.RATELIMIT_POLICY == 'defer' and retry_after <= config.RATELIMIT_MAX_DEFER:
+        namespace.server.sleep(retry_after)
+        retry_after = limiter.acquire(cost, sid=sid, room=room_name, addr=remote_addr)
+
+    if retry_after > 0:
+        print(f"Rate limited {sid} in room {room_name}")
+        namespace.emit('rate_limited', {
+            'data': "You are sending messages too fast. Please slow down.",
+            'retry_after': retry_after,
+            }, room=sid)
+        return False
+    return True
+
+
+def get_dashboard_relay(server=None):
+    """
+        Gets the dashboard relay of this worker, creating it if necessary.
+        With a server, also starts relaying to the admins.
+    """
+    global DASHBOARD_RELAY
+    if DASHBOARD_RELAY is None:
+        if local_backend():
+            DASHBOARD_RELAY = LocalDashboardRelay(interval=config.DASHBOARD_INTERVAL)
+        else:
+            DASHBOARD_RELAY = DashboardRelay(get_redis(), interval=config.DASHBOARD_INTERVAL)
+    if server is not None:
+        DASHBOARD_RELAY.start(server)
+    return DASHBOARD_RELAY
+
+
 def create_room(user, content):
     """
         Creates a new room on the persistent Database and returns the ID of the room
@@ -227,11 +810,36 @@ def get_msgcount(room_name):
         num_msgs, error = atomic_get(f"curr_msg_{room_name}")
         if not error:
             break
+    if num_msgs is None:
+        # The session has been reaped (or never started). Resume from the database
+        num_msgs = seed_msgcount(room_name)
     return int(num_msgs)
 
 
+def seed_msgcount(room_name):
+    """
+        Sets the message count shared variable from the database, unless someone else has set it
+    """
+    instance = ChatRoom.objects.filter(room_name=room_name).order_by('-num_msgs').first()
+    num_msgs = 0 if instance is None else instance.num_msgs
+    get_cache().setnx(f"curr_msg_{room_name}", num_msgs)
+    return int(get_cache().get(f"curr_msg_{room_name}"))
+
+
 
-class TemplateNamespace(socketio.Namespace):
+class ChatNamespace(socketio.Namespace):
+    """
+        The base of the chat namespaces, which records their events when tracing is enabled,
+        and profiles their handlers during a profiling session
+    """
+    def trigger_event(self, event, *args):
+        recorder = get_trace_recorder()
+        if recorder is not None:
+            recorder.record(self.namespace, event, args)
+        return get_profiler().call(f"{self.namespace}:{event}", super().trigger_event, event, *args)
+
+
+class TemplateNamespace(ChatNamespace):
     """
         The template chatbot routes go here
     """
@@ -239,22 +847,38 @@ class TemplateNamespace(socketio.Namespace):
         """
             Method call when connected to the socket
         """
+        if DRAINING:
+            return False
         print("Connected to Namespace template!")
+        start_background_tasks(self.server)
+        with self.session(sid) as session:
+            session['remote_addr'] = get_remote_addr(environ)
 
 
     def on_enter_room(self, sid, message):
         """
             Method call when entering a room
         """
-        global REDIS_CONNECTION
 
         user = get_user()
 
         room_name = message['room'].strip()
+        chatbot_user = room_to_chatbot_user[room_name]
+
+        # Every visitor gets a conversation of its own, which is keyed by its name from here on
+        conversation = room_name
+        if config.VISITOR_CONVERSATIONS:
+            conversation = conversation_name(room_name, visitor_id(message.get('visitor'), sid))
+
+        if not join_presence(self.namespace, sid, conversation):
+            print(f"Room {room_name} is full")
+            self.emit('room_full', {'data': f"Room {room_name} is full. Please try again later."},
+                      room=sid)
+            return
 
         with transaction.atomic():
             try:
-                instance = ChatRoom.objects.get(room_name=room_name)
+                instance = ChatRoom.objects.get(room_name=conversation)
             except ChatRoom.DoesNotExist:
                 instance = None
 
@@ -263,7 +887,7 @@ class TemplateNamespace(socketio.Namespace):
             # num_msgs = instance.num_msgs
         else:
             room_id = create_room(user, content={
-                'room_name': room_name,
+                'room_name': conversation,
                 'current_state': -1,
                 'num_msgs': 0,
             })
@@ -271,33 +895,36 @@ class TemplateNamespace(socketio.Namespace):
 
             print(f"Created room with id = {room_id}")
 
-        print(f"Entered room {room_name}")
+        print(f"Entered room {conversation}")
 
-        self.enter_room(sid, room=room_name)
-        current_state = get_last_state_from_redis(room_name)
+        self.enter_room(sid, room=conversation)
+        get_idle_claimer().touch(conversation)
+        current_state = get_last_state_from_redis(conversation)
 
-        chatbot_user = room_to_chatbot_user[room_name]
-
-        messages = fetch_recent_history(room_name)
+        messages = fetch_recent_history(conversation) or fetch_archived_history(conversation, room_id)
 
         if messages != []:
-            # Display the history
+            # Display the history, to this visitor only
             messages = sorted(messages, key=lambda d: d['msg_num'])
             for msg in messages:
-                self.emit('message', {'data': msg['message'], 'user': msg['user_name']},
-                          room=room_name)
+                self.emit('message', chat_payload({'data': msg['message'], 'user': msg['user_name']}),
+                          room=sid)
 
         with self.session(sid) as session:
             session['chatbot'] = ChatBotUser(
                 chatbot_user,
-                os.path.join(os.getcwd(), "chatbox/templates/chatbox/" + chatbot_user + ".json"),
-                REDIS_CONNECTION
+                template_path(chatbot_user),
+                get_cache(),
+                conversation,
+                session_id=sid,
+                funnel=get_funnel_recorder(),
             )
 
             session['curr_state'] = current_state
-            session['room_name'] = room_name
+            session['room'] = room_name
+            session['room_name'] = conversation
             session['room_id'] = room_id
-            session['num_msgs'] = get_msgcount(room_name)
+            session['num_msgs'] = get_msgcount(conversation)
 
 
 
@@ -307,17 +934,26 @@ class TemplateNamespace(socketio.Namespace):
         """
         room_name = message['data'].strip()
         with self.session(sid) as session:
-            room_name = None if session['room_name'] != room_name else room_name
+            conversation = session.get('room_name')
+            room_name = None if session.get('room', conversation) != room_name else room_name
         if room_name is not None:
-            self.leave_room(sid, room=room_name)
-            print(f"Exited room {room_name}")
+            self.leave_room(sid, room=conversation)
+            leave_presence(self.namespace, sid, conversation)
+            print(f"Exited room {conversation}")
 
 
     def on_message(self, sid, message):
         """
             Method call when a socket receives a message
         """
-        room_name = message['room']
+        with self.session(sid) as session:
+            # The conversation of this visitor in the room
+            room_name = session.get('room_name', message['room'])
+
+        # The room limit is per conversation, so that a busy room never throttles its other visitors
+        if not admit_message(self, sid, room_name, message['data']):
+            return
+        get_idle_claimer().touch(room_name)
 
         print(f"Sending {message}")
 
@@ -327,7 +963,7 @@ class TemplateNamespace(socketio.Namespace):
 
 
         if room_name is None:
-            self.emit('message', {'data': message['data']}, room=sid)
+            self.emit('message', chat_payload({'data': message['data']}), room=sid)
         else:
             user = get_user()
             msg_content = message['data']
@@ -343,25 +979,32 @@ class TemplateNamespace(socketio.Namespace):
             })
             num_msgs += 1
 
-            if CHATBOX_DEMO_APPLICATION:
-                self.emit('message', {'data': msg_content}, room=room_name)
+            if config.CHATBOX_DEMO_APPLICATION:
+                self.emit('message', chat_payload({'data': msg_content}), room=sid)
 
 
             if msg_content == 'dbupdate':
                 update_session_db(room_name)
 
             if msg_content == 'admin':
-                # Go to admin livechat
-                self.emit('livechat', {'data': "Redirecting to admin chat...."}, room=room_name)
+                # Go to admin livechat, with a grant to join this conversation only
+                self.emit('livechat', {
+                    'data': "Redirecting to admin chat....",
+                    'room': room_name,
+                    'token': grant_livechat(room_name),
+                    }, room=sid)
                 with self.session(sid) as session:
                     session['num_msgs'] = update_msgcount(room_name, num_msgs)
                 self.on_disconnect(sid)
+                # The session is gone, and the chatbot is done with this visitor
+                return
 
             with self.session(sid) as session:
                 if session['curr_state'] != -1:
                     # TODO: Change this! Get the user from the headers
                     user = get_user()
-                    reply, curr_state, msg_type = session['chatbot'].process_message(
+                    reply, curr_state, msg_type = get_profiler().call(
+                        'chatbot:process_message', session['chatbot'].process_message,
                         msg_content, session['curr_state'], user
                     )
 
@@ -378,12 +1021,12 @@ class TemplateNamespace(socketio.Namespace):
                     # Sending the reply
                     print(f"Emitting to room {room_name}")
 
-                    self.emit('message', {
+                    self.emit('message', chat_payload({
                         'type': 'chat_message_to_client',
                         'room_name': room_name,
                         'data': reply,
                         'message_type': msg_type,
-                        }, room=room_name)
+                        }), room=sid)
 
                     session['curr_state'] = curr_state
                     num_msgs = update_msgcount(room_name, num_msgs)
@@ -392,7 +1035,7 @@ class TemplateNamespace(socketio.Namespace):
                     # TODO: Make this a background task
                     update_session_redis(room_name, num_msgs + 1, {
                         'chat_room': room_name,
-                        'user_name': room_to_chatbot_user[room_name],
+                        'user_name': room_to_chatbot_user[base_room(room_name)],
                         'message': reply,
                         'msg_num': num_msgs + 1,
                         'room_id': str(room_id),
@@ -410,6 +1053,7 @@ class TemplateNamespace(socketio.Namespace):
         """
         print("Disconnecting from Namespace")
         with self.session(sid) as session:
+            leave_presence(self.namespace, sid, session['room_name'])
             print(f"Updating DB for {session['room_id']}...")
             # TODO: Update current state
             with transaction.atomic():
@@ -423,14 +1067,14 @@ class TemplateNamespace(socketio.Namespace):
 
         print('Done!')
         print('Flushing contents of the redis session...')
-        flush_session(session['room_name'], batch_size=10)
+        flush_session(session['room_name'])
         print('Done!')
         # Added call to self.disconnect()
         self.disconnect(sid)
         print("Disconnected successfully.")
 
 
-class AdminNamespace(socketio.Namespace):
+class AdminNamespace(ChatNamespace):
     """
         The Admin LiveChat routes go here
     """
@@ -438,7 +1082,13 @@ class AdminNamespace(socketio.Namespace):
         """
             Method call when the livechat socket gets connected
         """
+        if DRAINING:
+            return False
         print("Connected to Namespace admin!")
+        with self.session(sid) as session:
+            session['remote_addr'] = get_remote_addr(environ)
+            # Only the staff may watch the dashboard, or join any conversation
+            session['staff'] = is_staff(get_session_user(environ))
 
 
     def on_enter_room(self, sid, message):
@@ -446,6 +1096,13 @@ class AdminNamespace(socketio.Namespace):
             Method call when someone enters the livechat room
         """
         room_name = message['room'].strip()
+        with self.session(sid) as session:
+            staff = session.get('staff', False)
+        if not staff and not has_livechat_grant(message.get('token'), room_name):
+            print(f"Refused {sid} in room {room_name}: not an admin")
+            self.disconnect(sid)
+            return
+
         with transaction.atomic():
             try:
                 instance = ChatRoom.objects.get(room_name=room_name)
@@ -453,8 +1110,16 @@ class AdminNamespace(socketio.Namespace):
                 instance = None
 
         if instance is not None:
+            # The occupancy cap is that of the room of the conversation
+            if not join_presence(self.namespace, sid, room_name):
+                print(f"Room {room_name} is full")
+                self.emit('room_full', {'data': f"Room {room_name} is full. Please try again later."},
+                          room=sid)
+                return
+
             print(f"Entered room {room_name}")
             self.enter_room(sid, room=room_name)
+            get_idle_claimer().touch(room_name)
 
             with self.session(sid) as session:
                 session['room_name'] = room_name
@@ -463,13 +1128,13 @@ class AdminNamespace(socketio.Namespace):
             
             if session['user'] == 'admin':
                 # Fetch the recent history, if the user is admin
-                messages = fetch_recent_history(room_name)
+                messages = fetch_recent_history(room_name) or fetch_archived_history(room_name, instance.uuid)
 
                 if messages != []:
                     # Display the history
                     messages = sorted(messages, key=lambda d: d['msg_num'])
                     for msg in messages:
-                        self.emit('message', {'data': msg['message'], 'user': msg['user_name']},
+                        self.emit('message', chat_payload({'data': msg['message'], 'user': msg['user_name']}),
                                 room=room_name)
         else:
             print(f"Room {message['room']} not found in the Database. Disconnecting...")
@@ -486,6 +1151,7 @@ class AdminNamespace(socketio.Namespace):
             room_id = session['room_id']
         if room_id is not None:
             self.leave_room(sid, room=room_name)
+            leave_presence(self.namespace, sid, room_name)
             print(f"Exited room {room_name}")
         else:
             print(f"Room {message['room']} not found in the Database. Disconnecting...")
@@ -499,9 +1165,18 @@ class AdminNamespace(socketio.Namespace):
         """
         room_name = message['room']
 
+        with self.session(sid) as session:
+            # A visitor only ever talks in its own conversation
+            if not session.get('staff', False) and session.get('room_name') != room_name:
+                return
+
+        if not admit_message(self, sid, room_name, message['data']):
+            return
+        get_idle_claimer().touch(room_name)
+
         print(f"Sending {message}")
         print(f"Emitting to room {room_name}")
-        self.emit('message', {'data': message['data']}, room=room_name)
+        self.emit('message', chat_payload({'data': message['data']}), room=room_name)
 
         msg_content = message['data']
 
@@ -521,6 +1196,50 @@ class AdminNamespace(socketio.Namespace):
             num_msgs += 1
             num_msgs = update_msgcount(room_name, num_msgs)
 
+    def on_watch_dashboard(self, sid, message):
+        """
+            Method call when an admin subscribes to the dashboard.
+            Without a 'rooms' filter, activity from every room is pushed.
+        """
+        with self.session(sid) as session:
+            staff = session.get('staff', False)
+        if not staff:
+            print(f"Refused the dashboard to {sid}: not an admin")
+            self.disconnect(sid)
+            return
+
+        rooms = message.get('rooms') if message else None
+        relay = get_dashboard_relay(self.server)
+
+        with self.session(sid) as session:
+            # Drop any previous subscription
+            for room_name in session.get('dashboard_rooms') or []:
+                self.leave_room(sid, room=dashboard_room(room_name))
+            self.leave_room(sid, room=DASHBOARD_ROOM)
+            session['dashboard_rooms'] = rooms
+
+        if rooms is None:
+            self.enter_room(sid, room=DASHBOARD_ROOM)
+        else:
+            for room_name in rooms:
+                self.enter_room(sid, room=dashboard_room(room_name))
+
+        # Send the current state of the watched rooms, in a single emit
+        self.emit('dashboard_snapshot', {'rooms': relay.snapshot(rooms)}, room=sid)
+
+
+    def on_unwatch_dashboard(self, sid, message):
+        """
+            Method call when an admin unsubscribes from the dashboard
+        """
+        with self.session(sid) as session:
+            rooms = session.get('dashboard_rooms')
+            session['dashboard_rooms'] = None
+        for room_name in rooms or []:
+            self.leave_room(sid, room=dashboard_room(room_name))
+        self.leave_room(sid, room=DASHBOARD_ROOM)
+
+
     def on_disconnect(self, sid):
         """
             Method call when the livechat socket disconnects.
@@ -530,6 +1249,7 @@ class AdminNamespace(socketio.Namespace):
 
         try:
             with self.session(sid) as session:
+                leave_presence(self.namespace, sid, session['room_name'])
                 print(f"Updating DB for {session['room_id']}...")
                 obj = ChatRoom.objects.get(pk=session['room_id'])
                 while True:
@@ -543,7 +1263,7 @@ class AdminNamespace(socketio.Namespace):
                     update_session_db(session['room_name'])
             print('Done!')
             print('Flushing contents of the redis session...')
-            flush_session(session['room_name'], batch_size=10)
+            flush_session(session['room_name'])
             print('Done!')
             # Added call to self.disconnect()
             self.disconnect(sid)
@@ -0,0 +1,93 @@
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from chatbox.conf import config, get_redis
+from chatbox.cache import CACHE_STORES
+from chatbox.events import N
+from chatbox.records import (messages_key, meta_key, history_key, room_fields, pack_message,
+                             pack_history, unpack_history)
+
+
+def send_message(store, room_name, msg_num, content):
+    """
+        The cache operations of a chat message: the message count, the message, and the recent history
+    """
+    with store.pipeline() as pipe:
+        pipe.watch(f"curr_msg_{room_name}")
+        pipe.multi()
+        pipe.set(f"curr_msg_{room_name}", msg_num)
+        pipe.get(f"curr_msg_{room_name}")
+        pipe.execute()
+    with store.pipeline(transaction=False) as pipe:
+        pipe.hmset(meta_key(room_name), room_fields(content))
+        pipe.hset(messages_key(room_name), msg_num, pack_message(content))
+        pipe.lpush(history_key(room_name), pack_history(content))
+        pipe.ltrim(history_key(room_name), 0, N)
+        pipe.execute()
+    return [unpack_history(packed) for packed in store.lrange(history_key(room_name), 0, N)]
+
+
+def archive_room(store, room_name):
+    """
+        The cache operations of archiving then flushing a room
+    """
+    store.hgetall(meta_key(room_name))
+    msgs = list(store.hscan_iter(messages_key(room_name), count=500))
+    store.delete(messages_key(room_name), meta_key(room_name), history_key(room_name),
+                 f"curr_msg_{room_name}")
+    return len(msgs)
+
+
+class Command(BaseCommand):
+    help = 'Compare the latency of the chat paths on the Redis and the local cache stores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=100, help='Messages per room')
+        parser.add_argument('--length', type=int, default=40, help='Length of a chat line')
+        parser.add_argument('--backends', default='redis,local', help='Stores, comma separated')
+
+    def handle(self, *args, **options):
+        room_id = str(uuid.uuid4())
+        line = 'x' * options['length']
+
+        for name in options['backends'].split(','):
+            if name == 'local':
+                store = CACHE_STORES['local'](
+                    max_bytes=config.CACHE_LOCAL_MAX_BYTES,
+                    max_keys=config.CACHE_LOCAL_MAX_KEYS,
+                )
+            else:
+                store = CACHE_STORES['redis'](get_redis())
+
+            rooms = [f"bench_{uuid.uuid4().hex[:8]}" for _ in range(options['rooms'])]
+            latencies = []
+            start = time.perf_counter()
+            for msg_num in range(1, options['messages'] + 1):
+                for room_name in rooms:
+                    content = {
+                        'chat_room': room_name,
+                        'user_name': 'AnonymousUser' if msg_num % 2 else 'Susan',
+                        'message': line,
+                        'msg_num': msg_num,
+                        'room_id': room_id,
+                    }
+                    sent = time.perf_counter()
+                    send_message(store, room_name, msg_num, content)
+                    latencies.append((time.perf_counter() - sent) * 1000)
+            elapsed = time.perf_counter() - start
+
+            archive_start = time.perf_counter()
+            archived = sum(archive_room(store, room_name) for room_name in rooms)
+            archiving = time.perf_counter() - archive_start
+
+            latencies.sort()
+            self.stdout.write(
+                f"{name:>6}: {len(latencies) / elapsed:.0f} messages/s, "
+                f"p50 {statistics.median(latencies):.3f} ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.3f} ms, "
+                f"archived {archived} messages in {archiving * 1000:.1f} ms"
+            )
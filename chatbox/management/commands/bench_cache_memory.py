@@ -0,0 +1,64 @@
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from chatbox.conf import get_redis
+from chatbox.events import N, update_session_redis
+from chatbox.dashboard import forget_room
+
+
+def legacy_update_session_redis(room_name, msg_number, content):
+    """
+        The former layout: one hash per message, plus one hash per history slot
+    """
+    get_redis().hmset(room_name + "_" + str(msg_number), content)
+    get_redis().hmset(f"HISTORY_{room_name}_{msg_number % (N + 1)}", content)
+
+
+def memory_usage(pattern):
+    """
+        Sums up the memory used by every key matching `pattern`, in bytes
+    """
+    total = 0
+    for key in get_redis().scan_iter(pattern):
+        total += get_redis().execute_command('MEMORY', 'USAGE', key, 'SAMPLES', '0') or 0
+    return total
+
+
+class Command(BaseCommand):
+    help = 'Report the Redis memory used per cached message, for the legacy and the msgpack layouts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--length', type=int, default=40, help='Length of a chat line')
+
+    def handle(self, *args, **options):
+        num_msgs = options['messages']
+        room_id = str(uuid.uuid4())
+        line = ('x' * options['length'])
+
+        results = []
+        for name, update in (('legacy', legacy_update_session_redis), ('msgpack', update_session_redis)):
+            room_name = f"bench_{name}_{uuid.uuid4().hex[:8]}"
+            for msg_num in range(1, num_msgs + 1):
+                update(room_name, msg_num, {
+                    'chat_room': room_name,
+                    'user_name': 'AnonymousUser' if msg_num % 2 else 'Susan',
+                    'message': line,
+                    'msg_num': msg_num,
+                    'room_id': room_id,
+                })
+            used = memory_usage(f"{room_name}_*") + memory_usage(f"HISTORY_{room_name}*")
+            results.append((name, used))
+
+            # Clean up after ourselves
+            for key in get_redis().scan_iter(f"{room_name}_*"):
+                get_redis().delete(key)
+            for key in get_redis().scan_iter(f"HISTORY_{room_name}*"):
+                get_redis().delete(key)
+            forget_room(get_redis(), room_name)
+
+        self.stdout.write(f"{num_msgs} messages of {options['length']} characters")
+        for name, used in results:
+            self.stdout.write(f"{name:>8}: {used} bytes, {used / num_msgs:.1f} bytes/message")
+        self.stdout.write(f"Ratio: {results[0][1] / max(results[1][1], 1):.2f}x")
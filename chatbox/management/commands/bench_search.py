@@ -0,0 +1,62 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbox.search import SearchIndex
+
+WORDS = [
+    'hello', 'car', 'ferrari', 'audi', 'price', 'delivery', 'yes', 'no', 'thanks', 'admin',
+    'booking', 'service', 'engine', 'warranty', 'test', 'drive', 'colour', 'red', 'blue', 'loan',
+]
+
+
+class Command(BaseCommand):
+    help = 'Measure the search latency over archives of increasing size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help='Archive sizes (in messages), comma separated')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        rng = random.Random(0)
+        # Some rare words, so that the queries are not all matching most of the archive
+        vocabulary = WORDS + [f"word{idx}" for idx in range(5000)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = SearchIndex(os.path.join(directory, 'search.sqlite3'))
+            archived = 0
+            for size in sizes:
+                start = time.perf_counter()
+                while archived < size:
+                    batch = []
+                    for _ in range(min(options['batch_size'], size - archived)):
+                        archived += 1
+                        batch.append({
+                            'chat_room': f"room{archived % 1000}",
+                            'msg_num': archived,
+                            'user_name': 'AnonymousUser',
+                            'message': ' '.join(rng.choice(vocabulary) for _ in range(8)),
+                        })
+                    index.index_batch(batch)
+                indexing = time.perf_counter() - start
+
+                latencies = []
+                for _ in range(options['queries']):
+                    query = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, 2)))
+                    start = time.perf_counter()
+                    index.search(query, page=1, page_size=20)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                latencies.sort()
+
+                self.stdout.write(
+                    f"{size:>9} messages (indexed in {indexing:.1f}s): "
+                    f"p50 {statistics.median(latencies):.2f} ms, "
+                    f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms"
+                )
@@ -0,0 +1,104 @@
+import time
+from threading import Event, Thread
+
+import socketio
+from django.core.management.base import BaseCommand
+
+
+def server_rss(pid):
+    """
+        Gets the resident memory of the server process, in bytes
+    """
+    if pid is None:
+        return None
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+class BenchClient():
+    """
+        A visitor which sends messages to a room, and waits for a reply to each of them
+    """
+    def __init__(self, url, transport, room_name, timeout):
+        self.url = url
+        self.transport = transport
+        self.room_name = room_name
+        self.timeout = timeout
+        self.reply = Event()
+        self.round_trips = 0
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('message', self.on_message, namespace='/chat')
+
+
+    def on_message(self, message):
+        self.reply.set()
+
+
+    def connect(self):
+        self.client.connect(self.url, namespaces=['/chat'], transports=[self.transport])
+        self.client.emit('enter_room', {'room': self.room_name}, namespace='/chat')
+
+
+    def run(self, num_msgs):
+        for msg_num in range(num_msgs):
+            self.reply.clear()
+            self.client.emit('message', {'data': f"message {msg_num}", 'room': self.room_name},
+                             namespace='/chat')
+            if self.reply.wait(self.timeout):
+                self.round_trips += 1
+
+
+class Command(BaseCommand):
+    help = 'Measure the requests per second and the server memory per connection, for every transport'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000')
+        parser.add_argument('--transport', choices=['polling', 'websocket', 'both'], default='both')
+        parser.add_argument('--clients', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent by every client')
+        parser.add_argument('--room', default='lobby')
+        parser.add_argument('--timeout', type=float, default=5.0, help='Seconds to wait for a reply')
+        parser.add_argument('--server-pid', type=int, default=None,
+                            help='PID of the server, to sample its memory from /proc')
+
+    def handle(self, *args, **options):
+        transports = ['polling', 'websocket'] if options['transport'] == 'both' else [options['transport']]
+
+        self.stdout.write("The rate limits of the server should be raised (or disabled) for this run")
+        for transport in transports:
+            self.run_transport(transport, options)
+
+
+    def run_transport(self, transport, options):
+        num_clients = options['clients']
+        clients = [
+            BenchClient(options['url'], transport, options['room'], options['timeout'])
+            for _ in range(num_clients)
+        ]
+
+        rss_before = server_rss(options['server_pid'])
+        for client in clients:
+            client.connect()
+        rss_after = server_rss(options['server_pid'])
+
+        threads = [Thread(target=client.run, args=(options['messages'],)) for client in clients]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        for client in clients:
+            client.client.disconnect()
+
+        round_trips = sum(client.round_trips for client in clients)
+        sent = num_clients * options['messages']
+        self.stdout.write(f"[{transport}] {num_clients} clients, {round_trips}/{sent} replies "
+                          f"in {elapsed:.2f}s: {round_trips / elapsed:.1f} requests/s")
+        if rss_before is not None and rss_after is not None:
+            self.stdout.write(f"[{transport}] Server memory per connection: "
+                              f"{(rss_after - rss_before) / num_clients / 1024:.1f} KiB")
@@ -0,0 +1,81 @@
+import json
+import timeit
+
+import msgpack
+from django.core.management.base import BaseCommand
+
+from chatbox.wire import compact_payload, expand_payload
+
+# socket.io EVENT packet type
+EVENT = 2
+
+
+def json_encode(namespace, data):
+    """
+        Encodes an event packet the way the default socket.io serializer does
+    """
+    return f"{EVENT}{namespace},{json.dumps(data, separators=(',', ':'))}".encode('utf-8')
+
+
+def json_decode(packet):
+    return json.loads(packet.decode('utf-8').split(',', 1)[1])
+
+
+def msgpack_encode(namespace, data):
+    """
+        Encodes an event packet the way the msgpack socket.io serializer does
+    """
+    return msgpack.packb({'type': EVENT, 'nsp': namespace, 'data': data}, use_bin_type=True)
+
+
+def msgpack_decode(packet):
+    return msgpack.unpackb(packet, raw=False)['data']
+
+
+class Command(BaseCommand):
+    help = 'Compare the encode/decode CPU time and the size of a chat packet, for every wire format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100000)
+        parser.add_argument('--length', type=int, default=40, help='Length of a chat line')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        payload = {
+            'type': 'chat_message_to_client',
+            'room_name': 'lobby',
+            'data': 'x' * options['length'],
+            'message_type': 'text',
+        }
+
+        formats = [
+            ('json', json_encode, json_decode, False),
+            ('json+compact', json_encode, json_decode, True),
+            ('msgpack', msgpack_encode, msgpack_decode, False),
+            ('msgpack+compact', msgpack_encode, msgpack_decode, True),
+        ]
+
+        self.stdout.write(f"{'format':>16} {'bytes':>6} {'encode (us)':>12} {'decode (us)':>12}")
+        for name, encode, decode, compact in formats:
+            if compact:
+                def encode_packet():
+                    return encode('/chat', ['message', compact_payload(payload)])
+
+                def decode_packet(packet):
+                    return expand_payload(decode(packet)[1])
+            else:
+                def encode_packet():
+                    return encode('/chat', ['message', payload])
+
+                def decode_packet(packet):
+                    return decode(packet)[1]
+
+            packet = encode_packet()
+            assert decode_packet(packet) == payload
+
+            encode_time = timeit.timeit(encode_packet, number=iterations)
+            decode_time = timeit.timeit(lambda: decode_packet(packet), number=iterations)
+            self.stdout.write(
+                f"{name:>16} {len(packet):>6} "
+                f"{encode_time * 1e6 / iterations:>12.2f} {decode_time * 1e6 / iterations:>12.2f}"
+            )
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from chatbox.conf import config, parse_room_days
+from chatbox.events import get_search_index
+from chatbox.retention import apply_retention, prune_segments, update_rollups
+
+
+class Command(BaseCommand):
+    help = 'Apply the retention periods to the chat archive, compacting and rolling up the expired messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=config.RETENTION_DAYS,
+                            help='Number of days to retain, for the rooms without an override')
+        parser.add_argument('--room-days', default=None,
+                            help="Per-room overrides, as 'room:days,room:days'")
+        parser.add_argument('--batch-size', type=int, default=config.RETENTION_BATCH_SIZE)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between two delete batches')
+        parser.add_argument('--no-compact', action='store_true',
+                            help='Delete the expired messages without keeping a transcript')
+        parser.add_argument('--rollups-only', action='store_true')
+
+    def handle(self, *args, **options):
+        search_index = get_search_index() if config.SEARCH_ENABLED else None
+        if config.ARCHIVE_BACKEND == 'segment':
+            pruned = prune_segments(config.ARCHIVE_DIR, options['days'], search_index)
+            self.stdout.write(f"Pruned {pruned} archive segments")
+            return
+
+        if options['rollups_only']:
+            self.stdout.write(f"Updated {update_rollups()} rollups")
+            return
+
+        room_days = config.RETENTION_ROOM_DAYS
+        if options['room_days'] is not None:
+            room_days = parse_room_days(options['room_days'])
+
+        deleted = apply_retention(
+            options['days'], room_days, options['batch_size'],
+            compact_msgs=not options['no_compact'], pause=options['pause'], search_index=search_index,
+        )
+        for room_name, count in deleted.items():
+            room_name = 'other rooms' if room_name is None else room_name
+            self.stdout.write(f"{room_name}: pruned {count} messages")
@@ -0,0 +1,179 @@
+import math
+import statistics
+import time
+from threading import Lock, Thread
+
+import socketio
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbox.conf import config
+from chatbox.trace import read_trace
+
+# The events pushed by the server, any of which answers the last event sent by a client
+REPLY_EVENTS = ('message', 'livechat', 'room_full', 'rate_limited', 'reconnect_elsewhere',
+                'dashboard_snapshot', 'room_activity')
+
+
+def percentile(latencies, fraction):
+    # Nearest rank
+    return latencies[max(math.ceil(len(latencies) * fraction) - 1, 0)]
+
+
+class ReplayStats():
+    """
+        The latencies of the replayed events, per (namespace, event)
+    """
+    def __init__(self):
+        self.latencies = dict()
+        self.unanswered = dict()
+        self.lags = []
+        self.errors = 0
+        self.lock = Lock()
+
+
+    def add(self, key, latency):
+        with self.lock:
+            self.latencies.setdefault(key, []).append(latency)
+
+
+    def miss(self, key):
+        with self.lock:
+            self.unanswered[key] = self.unanswered.get(key, 0) + 1
+
+
+class ReplayClient():
+    """
+        Re-drives the events of a single client of the trace, on its own schedule
+    """
+    def __init__(self, url, namespace, events, stats, options):
+        self.url = url
+        self.namespace = namespace
+        self.events = events
+        self.stats = stats
+        self.options = options
+        self.pending = None
+        self.lock = Lock()
+        client_options = {'reconnection': False}
+        if config.SOCKETIO_SERIALIZER != 'default':
+            client_options['serializer'] = config.SOCKETIO_SERIALIZER
+        self.client = socketio.Client(**client_options)
+        for event in REPLY_EVENTS:
+            self.client.on(event, self.on_reply, namespace=namespace)
+
+
+    def on_reply(self, *args):
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is not None:
+            key, sent = pending
+            self.stats.add(key, (time.perf_counter() - sent) * 1000)
+
+
+    def sent(self, key):
+        with self.lock:
+            pending, self.pending = self.pending, (key, time.perf_counter())
+        if pending is not None:
+            self.stats.miss(pending[0])
+
+
+    def connect(self):
+        start = time.perf_counter()
+        self.client.connect(self.url, namespaces=[self.namespace],
+                            transports=self.options['transports'])
+        self.stats.add((self.namespace, 'connect'), (time.perf_counter() - start) * 1000)
+
+
+    def run(self, start):
+        try:
+            for elapsed, event, payload in self.events:
+                due = start + elapsed / 1000000 / self.options['speed']
+                time.sleep(max(due - time.perf_counter(), 0))
+                self.stats.lags.append((time.perf_counter() - due) * 1000)
+
+                if event == 'connect':
+                    if not self.client.connected:
+                        self.connect()
+                    continue
+                if not self.client.connected:
+                    # The trace started after this client had connected
+                    self.connect()
+                if event == 'disconnect':
+                    self.client.disconnect()
+                    continue
+                self.sent((self.namespace, event))
+                self.client.emit(event, payload, namespace=self.namespace)
+
+            # Wait for the reply to the last event
+            deadline = time.perf_counter() + self.options['timeout']
+            while self.pending is not None and time.perf_counter() < deadline:
+                time.sleep(0.01)
+        except Exception as ex:
+            print(f"Replay client failed: {ex}")
+            with self.stats.lock:
+                self.stats.errors += 1
+        finally:
+            if self.pending is not None:
+                self.stats.miss(self.pending[0])
+            if self.client.connected:
+                self.client.disconnect()
+
+
+class Command(BaseCommand):
+    help = 'Replay a recorded socket trace against a server, and report the latency of every event'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace', help='Path of the trace (see TRACE_ENABLED)')
+        parser.add_argument('--url', default='http://localhost:8000')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='Replay N times faster than recorded (1 for real time)')
+        parser.add_argument('--transport', choices=['polling', 'websocket'], default=None,
+                            help='Only use this transport (by default, the transports of the server)')
+        parser.add_argument('--timeout', type=float, default=5.0,
+                            help='Seconds to wait for the reply to the last event of a client')
+
+    def handle(self, *args, **options):
+        if options['speed'] <= 0:
+            raise CommandError('--speed must be positive')
+        options['transports'] = [options['transport']] if options['transport'] else None
+
+        try:
+            _, records = read_trace(options['trace'])
+        except (OSError, ValueError) as ex:
+            raise CommandError(str(ex))
+
+        # Client -> (namespace, events), in the order of the trace
+        clients = dict()
+        for elapsed, namespace, event, client, payload in records:
+            clients.setdefault(client, (namespace, []))[1].append((elapsed, event, payload))
+
+        duration = records[-1][0] / 1000000 if records else 0
+        self.stdout.write(f"Replaying {len(records)} events of {len(clients)} clients "
+                          f"({duration:.1f}s recorded, at {options['speed']}x)")
+
+        stats = ReplayStats()
+        replay_clients = [
+            ReplayClient(options['url'], namespace, events, stats, options)
+            for namespace, events in clients.values()
+        ]
+        start = time.perf_counter()
+        threads = [Thread(target=client.run, args=(start,)) for client in replay_clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(f"Replayed in {elapsed:.1f}s, {stats.errors} clients failed")
+        for key in sorted(set(stats.latencies) | set(stats.unanswered)):
+            latencies = sorted(stats.latencies.get(key, []))
+            line = f"{key[0]:>6} {key[1]:<16} {len(latencies):>6} replies, " \
+                   f"{stats.unanswered.get(key, 0):>5} unanswered"
+            if latencies:
+                line += (f", p50 {statistics.median(latencies):.1f} ms, "
+                         f"p90 {percentile(latencies, 0.9):.1f} ms, "
+                         f"p99 {percentile(latencies, 0.99):.1f} ms, max {latencies[-1]:.1f} ms")
+            self.stdout.write(line)
+        if stats.lags:
+            lags = sorted(stats.lags)
+            self.stdout.write(f"Schedule lag: p50 {statistics.median(lags):.1f} ms, "
+                              f"p99 {percentile(lags, 0.99):.1f} ms")
@@ -0,0 +1,112 @@
+"""
+chatbox/matching.py
+
+Matches the free-text answers of the visitors against the options of a template node.
+
+The options of a node are compiled once, when the template is loaded, into an
+`OptionMatcher`. An answer is then resolved in a single pass over its text, however
+many options the node has, trying in order:
+* The option itself, with the case and the whitespace folded ('  audi   r8' is 'Audi R8').
+* The number of the option, as listed by the chatbot ('1', '1.' or '1)').
+* A prefix of a single option, of at least `min_prefix` characters ('fer' is 'Ferrari').
+* The words of a single option: the answer must contain at least `token_threshold` of the
+  words which tell that option apart from the others ('the martin db9' is 'Aston Martin DB9').
+"""
+
+import re
+
+# A trie node, or a token, shared by several options
+AMBIGUOUS = -1
+
+NUMBER_PATTERN = re.compile(r'^#?(\d+)[.)]?$')
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+class OptionMatcher():
+    """
+        The lookup index of the options of a node.
+        `min_prefix` and `token_threshold` are 0 to disable the prefix and the token matches.
+    """
+    def __init__(self, options, min_prefix=1, token_threshold=0.5):
+        self.options = list(options)
+        self.min_prefix = min_prefix
+        self.token_threshold = token_threshold
+
+        # Normalized answer -> option index. The options win over the option numbers
+        self.exact = {str(idx): idx for idx in range(len(self.options))}
+        for idx, option in enumerate(self.options):
+            self.exact[normalize(option)] = idx
+
+        # Trie of the normalized options: character -> [children, option index]
+        self.trie = dict()
+        for idx, option in enumerate(self.options):
+            children = self.trie
+            for char in normalize(option):
+                node = children.setdefault(char, [dict(), idx])
+                if node[1] != idx:
+                    node[1] = AMBIGUOUS
+                children = node[0]
+
+        # Word -> option index, and the number of words telling every option apart
+        self.tokens = dict()
+        for idx, option in enumerate(self.options):
+            for token in set(tokenize(option)):
+                self.tokens[token] = idx if self.tokens.get(token, idx) == idx else AMBIGUOUS
+        self.distinct = [0] * len(self.options)
+        for idx in self.tokens.values():
+            if idx != AMBIGUOUS:
+                self.distinct[idx] += 1
+
+
+    def match(self, answer):
+        """
+            Gets the index of the option given by an answer, or None
+        """
+        if not isinstance(answer, str):
+            return None
+        text = normalize(answer)
+        if text in self.exact:
+            return self.exact[text]
+        number = NUMBER_PATTERN.match(text)
+        if number is not None:
+            idx = int(number.group(1))
+            return idx if idx < len(self.options) else None
+        idx = self.match_prefix(text)
+        return idx if idx is not None else self.match_tokens(text)
+
+
+    def match_prefix(self, text):
+        if self.min_prefix <= 0 or len(text) < self.min_prefix:
+            return None
+        children, idx = self.trie, AMBIGUOUS
+        for char in text:
+            node = children.get(char)
+            if node is None:
+                return None
+            children, idx = node
+        return None if idx == AMBIGUOUS else idx
+
+
+    def match_tokens(self, text):
+        if self.token_threshold <= 0:
+            return None
+        # Option index -> words of the answer telling it apart
+        hits = dict()
+        for token in set(tokenize(text)):
+            idx = self.tokens.get(token, AMBIGUOUS)
+            if idx != AMBIGUOUS:
+                hits[idx] = hits.get(idx, 0) + 1
+        if len(hits) != 1:
+            # No option, or several options are named
+            return None
+        idx, count = hits.popitem()
+        return idx if count / self.distinct[idx] >= self.token_threshold else None
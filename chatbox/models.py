@@ -17,5 +17,42 @@ class ChatboxMessage(models.Model):
     chat_room = models.CharField(max_length=1000)
     room_id = models.ForeignKey('ChatRoom', on_delete=models.CASCADE, db_column='room_id')
     user_name = models.CharField(max_length=1000)
-    msg_num = models.IntegerField(primary_key=True)
-    message = models.CharField(max_length=1000)
\ No newline at end of file
+    # The message numbers are counted per conversation, so they are only unique within a room
+    msg_num = models.IntegerField()
+    message = models.CharField(max_length=1000)
+    created_on = models.DateTimeField(_('message archived on'), auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('room_id', 'msg_num')
+
+
+class ChatRoomRollup(models.Model):
+    # Daily aggregates of the archived messages of a room, which outlive the retention period
+    room_id = models.ForeignKey('ChatRoom', on_delete=models.CASCADE, db_column='room_id')
+    chat_room = models.CharField(max_length=1000)
+    day = models.DateField()
+    num_msgs = models.PositiveIntegerField(default=0)
+    bot_msgs = models.PositiveIntegerField(default=0)
+    human_msgs = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('room_id', 'day')
+
+
+class ChatTranscript(models.Model):
+    # The compacted messages of a room, past the retention period
+    room_id = models.OneToOneField('ChatRoom', on_delete=models.CASCADE, db_column='room_id')
+    chat_room = models.CharField(max_length=1000)
+    first_msg = models.IntegerField(default=0)
+    last_msg = models.IntegerField(default=0)
+    num_msgs = models.PositiveIntegerField(default=0)
+    updated_on = models.DateTimeField(_('transcript updated on'), auto_now=True)
+
+
+class ChatTranscriptChunk(models.Model):
+    # A batch of compacted messages of a transcript, as zlib compressed JSON, appended once
+    transcript = models.ForeignKey('ChatTranscript', on_delete=models.CASCADE, related_name='chunks')
+    first_msg = models.IntegerField()
+    last_msg = models.IntegerField()
+    num_msgs = models.PositiveIntegerField()
+    chunk = models.BinaryField()
\ No newline at end of file
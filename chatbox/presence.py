@@ -0,0 +1,231 @@
+"""
+chatbox/presence.py
+
+Room presence, tracked on the Redis store so that it is shared by every worker.
+
+The members of a room (`MEMBERS_<room>`) are a sorted set of '<namespace>:<sid>',
+scored by their last heartbeat. Every worker refreshes the heartbeats of its own
+members in the background, so that the members of a worker which went away
+without a clean disconnect (a crash, a drain, a reap) expire after `ttl` seconds.
+Joining drops the expired members, checks the occupancy cap and adds the member
+in a single Lua call, and the occupancy of a room is a single ZCOUNT.
+`LocalPresence` keeps the members in the memory of the process instead, for the
+deployments without a Redis store (see `CACHE_BACKEND=local`).
+"""
+
+import time
+from threading import Lock
+
+# KEYS: The presence sorted set of the room
+# ARGV: The member, the occupancy cap (0 for no cap), now, the TTL of a heartbeat (0 for none)
+# Returns the occupancy after joining, or -1 if the room is full
+JOIN_SCRIPT = """
+local now = tonumber(ARGV[3])
+local ttl = tonumber(ARGV[4])
+if ttl > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - ttl)
+end
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[1])
+    return redis.call('ZCARD', KEYS[1])
+end
+local count = redis.call('ZCARD', KEYS[1])
+local cap = tonumber(ARGV[2])
+if cap > 0 and count >= cap then
+    return -1
+end
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], math.ceil(ttl))
+end
+return count + 1
+"""
+
+
+def presence_key(room_name):
+    return f"MEMBERS_{room_name}"
+
+
+def presence_member(namespace, sid):
+    return f"{namespace}:{sid}"
+
+
+class Presence():
+    """
+        Tracks the members of the rooms, with an occupancy cap of `capacity` (0 for no cap).
+        The members expire `ttl` seconds after their last heartbeat (0 for never).
+    """
+    def __init__(self, redis_connection, capacity=0, ttl=0):
+        self.redis_connection = redis_connection
+        self.capacity = capacity
+        self.ttl = ttl
+        self.script = redis_connection.register_script(JOIN_SCRIPT)
+        # The (room, member) joined through this worker, which it keeps alive
+        self.joined = set()
+        self.lock = Lock()
+
+
+    def join(self, room_name, member, capacity=None):
+        """
+            Adds a member to a room. Returns False if the room is full.
+            `capacity` overrides the occupancy cap of the tracker (0 for no cap).
+        """
+        capacity = self.capacity if capacity is None else capacity
+        joined = int(self.script(keys=[presence_key(room_name)],
+                                 args=[member, capacity, time.time(), self.ttl])) != -1
+        if joined:
+            with self.lock:
+                self.joined.add((room_name, member))
+        return joined
+
+
+    def leave(self, room_name, member):
+        """
+            Removes a member from a room
+        """
+        with self.lock:
+            self.joined.discard((room_name, member))
+        self.redis_connection.zrem(presence_key(room_name), member)
+
+
+    def release(self, members):
+        """
+            Removes the members (namespace:sid) joined through this worker from all their rooms,
+            in one round trip. Returns the number of removed members.
+        """
+        members = set(members)
+        with self.lock:
+            released = [(room_name, member) for room_name, member in self.joined if member in members]
+            self.joined.difference_update(released)
+        if released:
+            with self.redis_connection.pipeline(transaction=False) as pipe:
+                for room_name, member in released:
+                    pipe.zrem(presence_key(room_name), member)
+                pipe.execute()
+        return len(released)
+
+
+    def prune(self, room_name):
+        """
+            Removes the expired members of a room. Returns the number of removed members.
+        """
+        if self.ttl <= 0:
+            return 0
+        return self.redis_connection.zremrangebyscore(presence_key(room_name), '-inf', time.time() - self.ttl)
+
+
+    def heartbeat(self, connected=None):
+        """
+            Refreshes the members joined through this worker, in one round trip.
+            The members for which `connected(member)` is False are forgotten, and expire.
+        """
+        with self.lock:
+            if connected is not None:
+                self.joined = {(room, member) for room, member in self.joined if connected(member)}
+            joined = list(self.joined)
+        if joined == [] or self.ttl <= 0:
+            return 0
+        now = time.time()
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for room_name, member in joined:
+                pipe.execute_command('ZADD', presence_key(room_name), now, member)
+            for room_name in {room_name for room_name, _ in joined}:
+                pipe.expire(presence_key(room_name), int(self.ttl) + 1)
+            pipe.execute()
+        return len(joined)
+
+
+    def occupancy(self, rooms):
+        """
+            Gets the number of live members of every room, in one round trip
+        """
+        cutoff = time.time() - self.ttl if self.ttl > 0 else '-inf'
+        with self.redis_connection.pipeline(transaction=False) as pipe:
+            for room_name in rooms:
+                pipe.zcount(presence_key(room_name), cutoff, '+inf')
+            return dict(zip(rooms, pipe.execute()))
+
+
+class LocalPresence():
+    """
+        Tracks the members of the rooms of this process, with an occupancy cap of `capacity` (0 for no cap).
+        The members expire `ttl` seconds after their last heartbeat (0 for never).
+    """
+    def __init__(self, capacity=0, ttl=0):
+        self.capacity = capacity
+        self.ttl = ttl
+        # Room -> {member -> last heartbeat}
+        self.members = dict()
+        self.lock = Lock()
+
+
+    def live_members(self, room_name, now):
+        members = self.members.setdefault(room_name, dict())
+        if self.ttl > 0:
+            for member, last in list(members.items()):
+                if last <= now - self.ttl:
+                    del members[member]
+        return members
+
+
+    def join(self, room_name, member, capacity=None):
+        capacity = self.capacity if capacity is None else capacity
+        now = time.time()
+        with self.lock:
+            members = self.live_members(room_name, now)
+            if member not in members and capacity > 0 and len(members) >= capacity:
+                return False
+            members[member] = now
+            return True
+
+
+    def leave(self, room_name, member):
+        with self.lock:
+            members = self.members.get(room_name)
+            if members is not None:
+                members.pop(member, None)
+                if not members:
+                    del self.members[room_name]
+
+
+    def release(self, members):
+        members = set(members)
+        released = 0
+        with self.lock:
+            for room_name in list(self.members):
+                for member in members & set(self.members[room_name]):
+                    del self.members[room_name][member]
+                    released += 1
+                if not self.members[room_name]:
+                    del self.members[room_name]
+        return released
+
+
+    def prune(self, room_name):
+        with self.lock:
+            if room_name not in self.members:
+                return 0
+            count = len(self.members[room_name])
+            members = self.live_members(room_name, time.time())
+            if not members:
+                del self.members[room_name]
+            return count - len(members)
+
+
+    def heartbeat(self, connected=None):
+        now = time.time()
+        with self.lock:
+            for members in self.members.values():
+                for member in members:
+                    if connected is None or connected(member):
+                        members[member] = now
+            return sum(len(members) for members in self.members.values())
+
+
+    def occupancy(self, rooms):
+        cutoff = time.time() - self.ttl if self.ttl > 0 else float('-inf')
+        with self.lock:
+            return {
+                room_name: sum(last > cutoff for last in self.members.get(room_name, dict()).values())
+                for room_name in rooms
+            }
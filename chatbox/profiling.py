@@ -0,0 +1,218 @@
+"""
+chatbox/profiling.py
+
+On-demand profiling of the namespace handlers and of the chatbot engine.
+
+The admins switch the profiler on at runtime (see the `profile` view), for a
+time window and a sample rate. The window is stored on the cache store
+(`PROFILE_CONTROL`), and every worker picks it up in the background. While it is on:
+* A sampled fraction of the handler calls run under cProfile, and their stats are
+  aggregated per handler ('/chat:message', 'chatbot:process_message', ...).
+* A sampler thread walks the stacks of the threads which are running a handler,
+  every few milliseconds (with `sys._current_frames`), and counts them per handler
+  as collapsed stacks ('handler;frame;frame count', the input of flamegraph.pl).
+  Under eventlet, the handlers run on green threads, which the sampler cannot tell
+  apart, so only the cProfile stats are collected there.
+
+Once the window is over, the reports are written to a directory per session:
+a `<handler>.pstats` file per handler, and `stacks.collapsed`.
+When the profiler is off, a handler call only costs an attribute check.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import cProfile
+import pstats
+from threading import Lock, Thread, get_ident
+
+PROFILE_CONTROL_KEY = 'PROFILE_CONTROL'
+
+
+def read_control(cache):
+    """
+        Gets the profiling window requested by the admins: {session, sample_rate, until}
+    """
+    control = cache.get(PROFILE_CONTROL_KEY)
+    return None if control is None else json.loads(control.decode('utf-8'))
+
+
+def write_control(cache, control):
+    """
+        Requests a profiling window from every worker
+    """
+    ttl = max(int(control['until'] - time.time()), 0) + 3600
+    cache.set(PROFILE_CONTROL_KEY, json.dumps(control), ex=ttl)
+
+
+def green_threads():
+    """
+        Whether the handlers run on eventlet green threads. python-socketio picks eventlet
+        whenever it is installed, monkey-patched or not. The green threads of an OS thread
+        share its ident, and `sys._current_frames` only has the frame of the running one.
+    """
+    return 'eventlet' in sys.modules
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class HandlerProfiler():
+    """
+        Profiles the handler calls going through `call()`, during a profiling session
+    """
+    def __init__(self, directory, stack_interval=0.005):
+        self.directory = directory
+        self.stack_interval = stack_interval
+        self.active = False
+        self.session = None
+        self.sample_rate = 0
+        self.until = 0
+        # Handler -> pstats.Stats of the sampled calls
+        self.stats = dict()
+        # Collapsed stack -> number of samples
+        self.stacks = dict()
+        # Handler -> [calls, sampled calls]
+        self.calls = dict()
+        # Thread id -> handler running on the thread
+        self.running = dict()
+        self.sampler = None
+        self.lock = Lock()
+        # Only one cProfile can run at a time
+        self.profile_lock = Lock()
+
+
+    def start(self, session, sample_rate, until):
+        """
+            Starts a profiling session, until the `until` timestamp
+        """
+        if self.session is not None:
+            self.stop()
+        with self.lock:
+            self.stats, self.stacks, self.calls = dict(), dict(), dict()
+            self.session = session
+            self.sample_rate = sample_rate
+            self.until = until
+            self.active = True
+        if green_threads():
+            print("Profiling under eventlet: the stack sampler is off, only the pstats reports are written")
+        else:
+            self.sampler = Thread(target=self.sample_stacks, daemon=True)
+            self.sampler.start()
+        print(f"Profiling session {session} started, sampling {sample_rate:.0%} of the calls")
+
+
+    def stop(self):
+        """
+            Stops the profiling session, and writes its reports. Returns the directory of the reports.
+        """
+        self.active = False
+        if self.sampler is not None:
+            self.sampler.join(timeout=1)
+            self.sampler = None
+        with self.lock:
+            session, self.session = self.session, None
+            stats, stacks = self.stats, self.stacks
+        if session is None:
+            return None
+        return self.write_reports(session, stats, stacks)
+
+
+    def write_reports(self, session, stats, stacks):
+        directory = os.path.join(self.directory, f"profile-{session}-{os.getpid()}")
+        os.makedirs(directory, exist_ok=True)
+        for handler, handler_stats in stats.items():
+            name = re.sub(r'[^\w.-]+', '_', handler.strip('/'))
+            handler_stats.dump_stats(os.path.join(directory, name + '.pstats'))
+        with open(os.path.join(directory, 'stacks.collapsed'), 'w') as collapsed:
+            for stack, count in sorted(stacks.items()):
+                collapsed.write(f"{stack} {count}\n")
+        print(f"Profiling session {session} written to {directory}")
+        return directory
+
+
+    def status(self):
+        with self.lock:
+            return {
+                'session': self.session,
+                'active': self.active,
+                'sample_rate': self.sample_rate,
+                'until': self.until,
+                'calls': {handler: {'calls': calls, 'sampled': sampled}
+                          for handler, (calls, sampled) in self.calls.items()},
+            }
+
+
+    def call(self, handler, func, *args, **kwargs):
+        """
+            Calls `func`, profiling it if a session is on
+        """
+        if not self.active:
+            return func(*args, **kwargs)
+        if time.time() >= self.until:
+            # The window is over. The reports are written by stop()
+            self.active = False
+            return func(*args, **kwargs)
+
+        thread_id = get_ident()
+        outer = self.running.get(thread_id)
+        if outer is None:
+            self.running[thread_id] = handler
+        sampled = random.random() < self.sample_rate and self.profile_lock.acquire(blocking=False)
+        with self.lock:
+            counts = self.calls.setdefault(handler, [0, 0])
+            counts[0] += 1
+            counts[1] += int(sampled)
+        try:
+            if not sampled:
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiling tool (a debugger, coverage) is active
+                self.profile_lock.release()
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.profile_lock.release()
+                self.add_stats(handler, profile)
+        finally:
+            if outer is None:
+                self.running.pop(thread_id, None)
+
+
+    def add_stats(self, handler, profile):
+        with self.lock:
+            if handler in self.stats:
+                self.stats[handler].add(profile)
+            else:
+                self.stats[handler] = pstats.Stats(profile)
+
+
+    def sample_stacks(self):
+        """
+            The sampler thread: counts the stacks of the threads running a handler
+        """
+        while self.active and time.time() < self.until:
+            frames = sys._current_frames()
+            for thread_id, handler in list(self.running.items()):
+                frame = frames.get(thread_id)
+                names = []
+                while frame is not None:
+                    names.append(frame_name(frame))
+                    frame = frame.f_back
+                if names == []:
+                    continue
+                stack = ';'.join([handler] + names[::-1])
+                with self.lock:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            del frames
+            time.sleep(self.stack_interval)
@@ -0,0 +1,133 @@
+"""
+chatbox/ratelimit.py
+
+Token bucket rate limiting on the Redis store.
+
+Every subject of a message (the socket, the room, the remote address) owns a
+bucket. All the buckets of a message are checked and drawn from in a single
+Lua call, so a message is either admitted by every bucket or by none of them.
+`LocalRateLimiter` keeps the buckets in the memory of the process instead, for
+the deployments without a Redis store (see `CACHE_BACKEND=local`).
+"""
+
+import math
+import time
+from threading import Lock
+
+# KEYS: The buckets to draw from
+# ARGV: now (ms), cost, followed by (rate per second, burst) for every bucket
+# Returns 0 if the tokens were taken, or else the wait (ms) until they can be
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i + 1])
+    local burst = tonumber(ARGV[2 * i + 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or burst
+    local last = tonumber(bucket[2]) or now
+    available = math.min(burst, available + math.max(0, now - last) * rate / 1000)
+    -- A message costing more than the burst can only ever drain the bucket
+    local need = math.min(cost, burst)
+    if available < need then
+        wait = math.max(wait, math.ceil((need - available) * 1000 / rate))
+    end
+    tokens[i] = available - need
+end
+if wait > 0 then
+    return wait
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i + 1])
+    local burst = tonumber(ARGV[2 * i + 2])
+    redis.call('HMSET', key, 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return 0
+"""
+
+
+class RateLimiter():
+    """
+        Checks messages against the token buckets of their subjects.
+
+        `limits` maps a subject (eg: 'sid', 'room', 'addr') to a tuple of
+        (tokens per second, burst). A subject with a rate <= 0 is not limited.
+    """
+    def __init__(self, redis_connection, limits):
+        self.limits = {
+            subject: (float(rate), float(burst))
+            for subject, (rate, burst) in limits.items() if float(rate) > 0
+        }
+        self.script = redis_connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+    def draw(self, keys, args):
+        """
+            Runs the token bucket script. Returns the wait (ms), or 0 if the tokens were taken.
+        """
+        return int(self.script(keys=keys, args=args))
+
+
+    def acquire(self, cost=1, **subjects):
+        """
+            Takes `cost` tokens from the bucket of every subject.
+            Returns 0 if the message is admitted, or else the number of seconds to wait.
+        """
+        keys = []
+        args = [int(time.time() * 1000), cost]
+        for subject, value in subjects.items():
+            if value is None or subject not in self.limits:
+                continue
+            rate, burst = self.limits[subject]
+            keys.append(f"RATELIMIT_{subject}_{value}")
+            args.extend([rate, burst])
+
+        if keys == []:
+            return 0
+        return self.draw(keys, args) / 1000
+
+
+class LocalRateLimiter(RateLimiter):
+    """
+        Keeps the token buckets in the memory of the process, as per the same algorithm
+    """
+    def __init__(self, limits):
+        self.limits = {
+            subject: (float(rate), float(burst))
+            for subject, (rate, burst) in limits.items() if float(rate) > 0
+        }
+        # Key -> (tokens, ms timestamp, expiry ms timestamp)
+        self.buckets = dict()
+        self.pruned = 0
+        self.lock = Lock()
+
+
+    def draw(self, keys, args):
+        now, cost = args[0], args[1]
+        with self.lock:
+            wait = 0
+            tokens = []
+            for idx, key in enumerate(keys):
+                rate, burst = args[2 * idx + 2], args[2 * idx + 3]
+                available, last, expires = self.buckets.get(key, (burst, now, now + 1))
+                if expires <= now:
+                    available, last = burst, now
+                available = min(burst, available + max(0, now - last) * rate / 1000)
+                # A message costing more than the burst can only ever drain the bucket
+                need = min(cost, burst)
+                if available < need:
+                    wait = max(wait, math.ceil((need - available) * 1000 / rate))
+                tokens.append(available - need)
+            if wait > 0:
+                return wait
+            for idx, key in enumerate(keys):
+                rate, burst = args[2 * idx + 2], args[2 * idx + 3]
+                self.buckets[key] = (tokens[idx], now, now + math.ceil(burst * 1000 / rate) + 1000)
+            if now - self.pruned > 60 * 1000:
+                # Forget the idle buckets, which are full again, once a minute
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+                self.pruned = now
+            return 0
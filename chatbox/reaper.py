@@ -0,0 +1,102 @@
+"""
+chatbox/reaper.py
+
+Tracks the last activity of every room, so that abandoned sessions can be reaped.
+
+Every handler bumps the score of its room in the `ROOM_ACTIVITY` sorted set.
+The reaper pops the rooms which have been idle for too long in bounded batches,
+and archives then flushes each of them (see `reap_idle_rooms` in chatbox/events.py).
+`LocalIdleRoomClaimer` tracks the rooms of this process in memory instead, for the
+deployments without a Redis store (see `CACHE_BACKEND=local`).
+"""
+
+import time
+from threading import Lock
+
+ACTIVITY_KEY = 'ROOM_ACTIVITY'
+
+# KEYS: The activity sorted set
+# ARGV: cutoff (the rooms with an older last activity are idle), batch size
+# Atomically pops a batch of idle rooms, so that every room is reaped by a single worker
+CLAIM_IDLE_SCRIPT = """
+local rooms = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #rooms > 0 then
+    redis.call('ZREM', KEYS[1], unpack(rooms))
+end
+return rooms
+"""
+
+
+def touch_room(redis_connection, room_name):
+    """
+        Marks a room as active now
+    """
+    redis_connection.execute_command('ZADD', ACTIVITY_KEY, time.time(), room_name)
+
+
+class IdleRoomClaimer():
+    """
+        Pops the rooms which have been idle for more than `idle_timeout` seconds
+    """
+    def __init__(self, redis_connection, idle_timeout):
+        self.redis_connection = redis_connection
+        self.idle_timeout = idle_timeout
+        self.script = redis_connection.register_script(CLAIM_IDLE_SCRIPT)
+
+
+    def touch(self, room_name):
+        """
+            Marks a room as active now
+        """
+        touch_room(self.redis_connection, room_name)
+
+
+    def claim(self, batch_size):
+        """
+            Pops at most `batch_size` idle rooms
+        """
+        cutoff = time.time() - self.idle_timeout
+        rooms = self.script(keys=[ACTIVITY_KEY], args=[cutoff, batch_size])
+        return [room_name.decode('utf-8') for room_name in rooms]
+
+
+    def release(self, room_name):
+        """
+            Puts back a room which could not be reaped, to retry it on the next tick.
+            A room which has become active in the meantime keeps its score.
+        """
+        score = time.time() - self.idle_timeout
+        self.redis_connection.execute_command('ZADD', ACTIVITY_KEY, 'NX', score, room_name)
+
+
+class LocalIdleRoomClaimer():
+    """
+        Tracks the last activity of the rooms of this process, and pops those idle
+        for more than `idle_timeout` seconds
+    """
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        # Room -> last activity
+        self.activity = dict()
+        self.lock = Lock()
+
+
+    def touch(self, room_name):
+        with self.lock:
+            self.activity[room_name] = time.time()
+
+
+    def claim(self, batch_size):
+        cutoff = time.time() - self.idle_timeout
+        with self.lock:
+            rooms = sorted(
+                (last, room_name) for room_name, last in self.activity.items() if last <= cutoff
+            )[:batch_size]
+            for _, room_name in rooms:
+                del self.activity[room_name]
+        return [room_name for _, room_name in rooms]
+
+
+    def release(self, room_name):
+        with self.lock:
+            self.activity.setdefault(room_name, time.time() - self.idle_timeout)
@@ -0,0 +1,81 @@
+"""
+chatbox/records.py
+
+Compact msgpack encoding of the messages cached on the Redis store.
+
+A room keeps all of its messages in a single hash (`<room>_msgs`), keyed by the
+message number, and its recent history in a single capped list (`HISTORY_<room>`).
+The fields which are the same for every message of a room (`chat_room`, `room_id`)
+are factored out, and stored once in `<room>_meta`.
+"""
+
+import msgpack
+
+
+def messages_key(room_name):
+    """
+        The hash holding every cached message of the room
+    """
+    return f"{room_name}_msgs"
+
+
+def meta_key(room_name):
+    """
+        The hash holding the room-level fields of the cached messages
+    """
+    return f"{room_name}_meta"
+
+
+def history_key(room_name):
+    """
+        The capped list holding the recent history of the room, newest first
+    """
+    return f"HISTORY_{room_name}"
+
+
+def room_fields(content):
+    """
+        Gets the room-level fields of a message
+    """
+    return {'chat_room': content['chat_room'], 'room_id': content['room_id']}
+
+
+def pack_message(content):
+    """
+        Encodes the per-message fields of a message
+    """
+    return msgpack.packb([content['user_name'], content['message']], use_bin_type=True)
+
+
+def unpack_message(msg_num, packed, fields):
+    """
+        Decodes a message, merging it with the room-level `fields`
+    """
+    user_name, message = msgpack.unpackb(packed, raw=False)
+    content = dict(fields)
+    content.update({'user_name': user_name, 'message': message, 'msg_num': int(msg_num)})
+    return content
+
+
+def pack_history(content):
+    """
+        Encodes a message for the recent history
+    """
+    return msgpack.packb(
+        [int(content['msg_num']), content['user_name'], content['message']], use_bin_type=True
+    )
+
+
+def unpack_history(packed):
+    """
+        Decodes a message of the recent history
+    """
+    msg_num, user_name, message = msgpack.unpackb(packed, raw=False)
+    return {'msg_num': msg_num, 'user_name': user_name, 'message': message}
+
+
+def decode_fields(content):
+    """
+        Decodes a hash fetched from the Redis store
+    """
+    return {key.decode('utf-8'): value.decode('utf-8') for key, value in content.items()}
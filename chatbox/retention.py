@@ -0,0 +1,203 @@
+"""
+chatbox/retention.py
+
+Retention, compaction and rollups for the chat archive.
+
+* Rollups: The daily aggregates (messages, bot vs human messages) of every room
+  are kept in `ChatRoomRollup`, and outlive the archived messages.
+* Compaction: Before the messages of a room past its retention period are
+  deleted, they are appended to the `ChatTranscript` of the room, as one
+  compressed `ChatTranscriptChunk` per batch.
+* Retention: The expired messages are compacted and deleted in bounded batches,
+  each in its own short transaction, so that the table is never locked for long,
+  and a message is never both compacted and kept.
+"""
+
+import os
+import json
+import mmap
+import time
+import zlib
+from datetime import datetime, time as dtime, timedelta
+
+from django.db import transaction, IntegrityError
+from django.db.models import Count, Q, Max, F
+from django.db.models.functions import TruncDate, Least, Greatest
+from django.utils import timezone
+
+from .archive import segment_records
+from .chatbot import room_to_chatbot_user
+from .conversations import conversation_prefix
+from .models import ChatboxMessage, ChatRoomRollup, ChatTranscript, ChatTranscriptChunk
+
+
+def day_cutoff(days):
+    """
+        The start of the first day to retain, so that days are always pruned whole
+    """
+    today = timezone.localdate()
+    return timezone.make_aware(datetime.combine(today - timedelta(days=days), dtime.min))
+
+
+def update_rollups():
+    """
+        Recomputes the rollups from the most recent rolled up day onwards.
+        The older days are final, since messages are only ever archived today.
+    """
+    latest = ChatRoomRollup.objects.aggregate(latest=Max('day'))['latest']
+    queryset = ChatboxMessage.objects.all()
+    if latest is not None:
+        queryset = queryset.filter(created_on__gte=timezone.make_aware(
+            datetime.combine(latest, dtime.min)
+        ))
+
+    bot_names = set(room_to_chatbot_user.values())
+    aggregates = queryset.annotate(day=TruncDate('created_on')).values(
+        'room_id', 'chat_room', 'day'
+    ).annotate(
+        num_msgs=Count('pk'),
+        bot_msgs=Count('pk', filter=Q(user_name__in=bot_names)),
+    )
+
+    num_rollups = 0
+    for aggregate in aggregates:
+        defaults = {
+            'chat_room': aggregate['chat_room'],
+            'num_msgs': aggregate['num_msgs'],
+            'bot_msgs': aggregate['bot_msgs'],
+            'human_msgs': aggregate['num_msgs'] - aggregate['bot_msgs'],
+        }
+        try:
+            with transaction.atomic():
+                ChatRoomRollup.objects.update_or_create(
+                    room_id_id=aggregate['room_id'], day=aggregate['day'], defaults=defaults
+                )
+        except IntegrityError:
+            # Someone else has created it first
+            ChatRoomRollup.objects.filter(
+                room_id_id=aggregate['room_id'], day=aggregate['day']
+            ).update(**defaults)
+        num_rollups += 1
+    return num_rollups
+
+
+def compact(msgs):
+    """
+        Appends a batch of expired messages to the transcripts of their rooms, as one chunk per room.
+        The former chunks are never read back, so this costs the same for every batch.
+    """
+    by_room = dict()
+    for msg in msgs:
+        by_room.setdefault(msg.room_id_id, []).append(msg)
+
+    chunks = []
+    for room_id, room_msgs in by_room.items():
+        lines = [
+            [msg.msg_num, msg.user_name, msg.message, msg.created_on.isoformat()]
+            for msg in room_msgs
+        ]
+        first_msg = min(line[0] for line in lines)
+        last_msg = max(line[0] for line in lines)
+        instance, created = ChatTranscript.objects.get_or_create(
+            room_id_id=room_id, defaults={
+                'chat_room': room_msgs[0].chat_room,
+                'first_msg': first_msg,
+                'last_msg': last_msg,
+                'num_msgs': len(lines),
+            }
+        )
+        if not created:
+            ChatTranscript.objects.filter(pk=instance.pk).update(
+                first_msg=Least('first_msg', first_msg),
+                last_msg=Greatest('last_msg', last_msg),
+                num_msgs=F('num_msgs') + len(lines),
+                updated_on=timezone.now(),
+            )
+        chunks.append(ChatTranscriptChunk(
+            transcript=instance, first_msg=first_msg, last_msg=last_msg, num_msgs=len(lines),
+            chunk=zlib.compress(json.dumps(lines).encode('utf-8')),
+        ))
+    ChatTranscriptChunk.objects.bulk_create(chunks)
+
+
+def read_transcript(transcript):
+    """
+        Gets the compacted messages of a transcript, as [msg_num, user_name, message, created_on] lines
+    """
+    lines = []
+    for chunk in transcript.chunks.order_by('pk').values_list('chunk', flat=True):
+        lines.extend(json.loads(zlib.decompress(chunk).decode('utf-8')))
+    return lines
+
+
+def prune_messages(queryset, batch_size, compact_msgs=True, pause=0, search_index=None):
+    """
+        Deletes the messages of `queryset` in batches of at most `batch_size` rows,
+        compacting them first, in the same transaction, then removes them from `search_index`.
+        Returns the number of deleted messages.
+    """
+    deleted = 0
+    while True:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if pks == []:
+            break
+        with transaction.atomic():
+            # Lock the batch, so that a concurrent prune finds it gone instead of compacting it twice
+            msgs = list(ChatboxMessage.objects.select_for_update().filter(pk__in=pks).order_by('msg_num'))
+            if compact_msgs:
+                compact(msgs)
+            count, _ = ChatboxMessage.objects.filter(pk__in=[msg.pk for msg in msgs]).delete()
+        if search_index is not None:
+            search_index.remove((msg.chat_room, msg.msg_num) for msg in msgs)
+        deleted += count
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def apply_retention(default_days, room_days=None, batch_size=500, compact_msgs=True, pause=0,
+                    search_index=None):
+    """
+        Applies the retention periods to the archive, after bringing the rollups up to date.
+        `room_days` overrides `default_days` for some rooms, and for their conversations.
+        The deleted messages are removed from `search_index` too. Returns {room: deleted messages}.
+    """
+    room_days = room_days or dict()
+    update_rollups()
+
+    deleted = dict()
+    overridden = Q(pk__in=[])
+    for room_name, days in room_days.items():
+        in_room = Q(chat_room=room_name) | Q(chat_room__startswith=conversation_prefix(room_name))
+        overridden |= in_room
+        queryset = ChatboxMessage.objects.filter(in_room, created_on__lt=day_cutoff(days))
+        deleted[room_name] = prune_messages(queryset, batch_size, compact_msgs, pause, search_index)
+
+    queryset = ChatboxMessage.objects.filter(created_on__lt=day_cutoff(default_days)).exclude(
+        overridden
+    )
+    deleted[None] = prune_messages(queryset, batch_size, compact_msgs, pause, search_index)
+    return deleted
+
+
+def prune_segments(directory, days, search_index=None):
+    """
+        Deletes the archive segments older than `days`, for the segment archive backend,
+        removing their messages from `search_index` first.
+        Segments hold every room, so only the default retention period applies.
+    """
+    cutoff = (timezone.localdate() - timedelta(days=days)).strftime('%Y-%m-%d')
+    pruned = 0
+    for name in sorted(os.listdir(directory)):
+        day, extension = os.path.splitext(name)
+        if extension not in ('.seg', '.index') or day >= cutoff:
+            continue
+        path = os.path.join(directory, name)
+        if extension == '.seg' and search_index is not None and os.path.getsize(path) > 0:
+            with open(path, 'rb') as segment:
+                with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    search_index.remove((content['chat_room'], content['msg_num'])
+                                        for _, content in segment_records(buffer))
+        os.remove(path)
+        pruned += extension == '.seg'
+    return pruned
@@ -0,0 +1,129 @@
+"""
+chatbox/search.py
+
+An incrementally maintained full-text index over the chat archive, for the admins.
+
+The index lives in its own SQLite database, using an FTS5 table. Every batch the
+archiver writes is indexed in a single transaction. Messages which are archived
+twice (eg: after a `dbupdate`) are only indexed once. The retention removes the
+messages it deletes from the archive.
+"""
+
+import sqlite3
+from threading import Lock
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+    message, room UNINDEXED, msg_num UNINDEXED, user_name UNINDEXED, tokenize='unicode61'
+);
+CREATE TABLE IF NOT EXISTS indexed (
+    room TEXT NOT NULL, msg_num INTEGER NOT NULL, docid INTEGER, PRIMARY KEY (room, msg_num)
+) WITHOUT ROWID;
+"""
+
+
+def match_query(query):
+    """
+        Turns the search terms into an FTS5 query, matching every term as a prefix
+    """
+    terms = [term.replace('"', '""') for term in query.split()]
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+class SearchIndex():
+    """
+        The full-text index of the archived messages, stored at `path`
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.ready = False
+
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        with self.lock:
+            if not self.ready:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.executescript(SCHEMA)
+                self.ready = True
+        return connection
+
+
+    def index_batch(self, messages):
+        """
+            Adds a batch of archived messages to the index. Returns the number of new messages.
+        """
+        added = 0
+        connection = self.connect()
+        try:
+            with connection:
+                for content in messages:
+                    cursor = connection.execute(
+                        'INSERT OR IGNORE INTO indexed (room, msg_num) VALUES (?, ?)',
+                        (content['chat_room'], int(content['msg_num']))
+                    )
+                    if cursor.rowcount == 1:
+                        cursor = connection.execute(
+                            'INSERT INTO messages (message, room, msg_num, user_name) VALUES (?, ?, ?, ?)',
+                            (content['message'], content['chat_room'], int(content['msg_num']),
+                             content['user_name'])
+                        )
+                        connection.execute(
+                            'UPDATE indexed SET docid = ? WHERE room = ? AND msg_num = ?',
+                            (cursor.lastrowid, content['chat_room'], int(content['msg_num']))
+                        )
+                        added += 1
+        finally:
+            connection.close()
+        return added
+
+
+    def remove(self, keys):
+        """
+            Removes archived messages, given as (room, msg_num), from the index. Returns the number of removed messages.
+        """
+        removed = 0
+        connection = self.connect()
+        try:
+            with connection:
+                for room, msg_num in keys:
+                    row = connection.execute(
+                        'SELECT docid FROM indexed WHERE room = ? AND msg_num = ?', (room, int(msg_num))
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    connection.execute('DELETE FROM indexed WHERE room = ? AND msg_num = ?', (room, int(msg_num)))
+                    connection.execute('DELETE FROM messages WHERE rowid = ?', (row[0],))
+                    removed += 1
+        finally:
+            connection.close()
+        return removed
+
+
+    def search(self, query, page=1, page_size=20):
+        """
+            Gets a page of the best matching messages, as (hits, has_more)
+        """
+        expression = match_query(query)
+        if expression == '':
+            return [], False
+
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                "SELECT room, msg_num, user_name, snippet(messages, 0, '[', ']', '...', 12), rank "
+                "FROM messages WHERE messages MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+                (expression, page_size + 1, (page - 1) * page_size)
+            ).fetchall()
+        finally:
+            connection.close()
+
+        hits = [{
+            'room': room,
+            'msg_num': msg_num,
+            'user_name': user_name,
+            'snippet': snippet,
+            'score': -rank,
+        } for room, msg_num, user_name, snippet, rank in rows[:page_size]]
+        return hits, len(rows) > page_size
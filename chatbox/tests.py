@@ -1,3 +1,490 @@
-from django.test import TestCase
+import os
+import sys
+import time
+import uuid
+import tempfile
+import subprocess
+from datetime import timedelta
+from unittest import SkipTest
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+import socketio
+import engineio
+
+from chatbox import events, archive, views
+from chatbox.matching import OptionMatcher
+from chatbox.cache import LocalCacheStore
+from chatbox.ratelimit import RateLimiter, LocalRateLimiter
+from chatbox.conf import get_redis
+from chatbox.presence import Presence, LocalPresence, presence_member
+from chatbox.reaper import LocalIdleRoomClaimer
+from chatbox.records import (pack_message, unpack_message, pack_history, unpack_history,
+                             messages_key, history_key)
+from chatbox.conversations import conversation_name, base_room, visitor_id
+from chatbox.archive import ORMArchiveBackend, SegmentLogArchiveBackend
+from chatbox.retention import apply_retention, prune_segments, read_transcript
+from chatbox.search import SearchIndex
+from chatbox.models import ChatRoom, ChatboxMessage, ChatTranscript
+
+# Importing the application must stay cheap, and side-effect free
+IMPORT_TIME_BUDGET_MS = float(os.environ.get('IMPORT_TIME_BUDGET_MS', 1500))
+
+IMPORT_SCRIPT = """
+import django
+django.setup()
+import chatbox.events
+import chatbox.views
+import chatbox_socketio.wsgi
+from chatbox import conf, views
+assert conf.REDIS_CONNECTION is None, 'Importing the application connected to the Redis store'
+assert conf.config.repository is None, 'Importing the application read the settings'
+assert views.SIO is None, 'Importing the application built the Socket.IO server'
+"""
+
+
+class ImportTest(SimpleTestCase):
+    def test_import_application(self):
+        # In a fresh interpreter, since the other tests load the settings
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'chatbox_socketio.settings')
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        # Lines of -X importtime: "import time: <self us> | <cumulative us> | <module>", the module
+        # indented by its depth. The top-level chatbox modules add up to the whole application.
+        cumulative_us = 0
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            self_us, module_us, module = line[len('import time:'):].split('|')
+            if not module_us.strip().isdigit() or module.startswith('  '):
+                continue
+            if module.strip().split('.')[0] in ('chatbox', 'chatbox_socketio'):
+                cumulative_us += int(module_us)
+
+        self.assertGreater(cumulative_us, 0, 'chatbox was not imported')
+        print(f"chatbox: {cumulative_us / 1000:.1f} ms")
+        self.assertLess(cumulative_us / 1000, IMPORT_TIME_BUDGET_MS)
+
+
+def redis_or_skip():
+    """
+        The Redis store of the settings, for the tests of the Lua scripts
+    """
+    try:
+        get_redis().ping()
+    except Exception:
+        raise SkipTest('No Redis store')
+    return get_redis()
+
+
+def test_room():
+    return f"test_{uuid.uuid4().hex[:8]}"
+
+
+class LocalCacheStoreTest(SimpleTestCase):
+    def test_values(self):
+        store = LocalCacheStore()
+        store.set('count', 3)
+        self.assertEqual(store.get('count'), b'3')
+        self.assertFalse(store.setnx('count', 4))
+        self.assertTrue(store.setnx('other', 'x'))
+        store.hmset('meta', {'room': 'lobby', 'num': 1})
+        self.assertEqual(store.hgetall('meta'), {b'room': b'lobby', b'num': b'1'})
+        self.assertEqual(store.hget('meta', 'room'), b'lobby')
+        self.assertIsNone(store.hget('meta', 'missing'))
+        store.lpush('history', 'a', 'b', 'c')
+        store.ltrim('history', 0, 1)
+        self.assertEqual(store.lrange('history', 0, -1), [b'c', b'b'])
+        self.assertEqual(store.delete('count', 'meta', 'missing'), 2)
+        self.assertIsNone(store.get('count'))
+        with self.assertRaises(TypeError):
+            store.get('history')
+
+    def test_lru_eviction(self):
+        store = LocalCacheStore(max_keys=2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+        # 'b' is the least recently used
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), b'1')
+        self.assertEqual(store.evictions, 1)
+
+        store = LocalCacheStore(max_bytes=1000)
+        for idx in range(20):
+            store.set(f"key{idx}", 'x' * 100)
+        self.assertLessEqual(store.used_bytes, 1000)
+        self.assertEqual(store.get('key19'), b'x' * 100)
+        self.assertIsNone(store.get('key0'))
+
+    def test_ttl(self):
+        store = LocalCacheStore(default_ttl=60)
+        store.set('short', 1, ex=0.05)
+        store.set('long', 1)
+        store.hset('hash', 'field', 1)
+        store.expire('hash', 0.05)
+        time.sleep(0.1)
+        self.assertIsNone(store.get('short'))
+        self.assertEqual(store.hgetall('hash'), {})
+        self.assertEqual(store.get('long'), b'1')
+
+    def test_pipeline(self):
+        store = LocalCacheStore()
+        with store.pipeline(transaction=False) as pipe:
+            pipe.set('a', 1)
+            pipe.get('a')
+            pipe.lpush('list', 'x')
+            self.assertIsNone(store.get('a'))
+            self.assertEqual(pipe.execute(), [True, b'1', 1])
+        self.assertEqual(store.get('a'), b'1')
+
+    def test_watch_multi(self):
+        store = LocalCacheStore()
+        store.set('count', 1)
+        with store.pipeline() as pipe:
+            pipe.watch('count')
+            # Until multi(), the commands run immediately
+            count = int(pipe.get('count'))
+            pipe.multi()
+            pipe.set('count', count + 1)
+            pipe.get('count')
+            self.assertEqual(store.get('count'), b'1')
+            self.assertEqual(pipe.execute()[-1], b'2')
+
+
+class LocalCoordinationTest(SimpleTestCase):
+    def test_rate_limiter(self):
+        limiter = LocalRateLimiter({'sid': (1, 2), 'room': (0, 5)})
+        self.assertEqual(limiter.acquire(sid='a', room='lobby'), 0)
+        self.assertEqual(limiter.acquire(sid='a', room='lobby'), 0)
+        self.assertAlmostEqual(limiter.acquire(sid='a', room='lobby'), 1, delta=0.1)
+        # Another socket has a bucket of its own
+        self.assertEqual(limiter.acquire(sid='b'), 0)
+
+    def test_presence(self):
+        presence = LocalPresence(capacity=1)
+        self.assertTrue(presence.join('lobby', '/chat:a'))
+        self.assertTrue(presence.join('lobby', '/chat:a'))
+        self.assertFalse(presence.join('lobby', '/chat:b'))
+        presence.leave('lobby', '/chat:a')
+        self.assertTrue(presence.join('lobby', '/chat:b'))
+        self.assertEqual(presence.occupancy(['lobby', 'default']), {'lobby': 1, 'default': 0})
+        # The conversations are not capped
+        self.assertTrue(presence.join('lobby~b', '/chat:b', capacity=0))
+        self.assertTrue(presence.join('lobby~b', '/admin:c', capacity=0))
+
+    def test_presence_expiry(self):
+        presence = LocalPresence(capacity=1, ttl=0.1)
+        self.assertTrue(presence.join('lobby', '/chat:a'))
+        self.assertFalse(presence.join('lobby', '/chat:b'))
+        time.sleep(0.15)
+        # '/chat:a' went away without leaving
+        self.assertEqual(presence.occupancy(['lobby']), {'lobby': 0})
+        self.assertTrue(presence.join('lobby', '/chat:b'))
+
+    def test_idle_rooms(self):
+        claimer = LocalIdleRoomClaimer(idle_timeout=0.05)
+        claimer.touch('lobby~a')
+        self.assertEqual(claimer.claim(10), [])
+        time.sleep(0.1)
+        claimer.touch('lobby~b')
+        self.assertEqual(claimer.claim(10), ['lobby~a'])
+        self.assertEqual(claimer.claim(10), [])
+
+
+class OptionMatcherTest(SimpleTestCase):
+    def test_answers(self):
+        matcher = OptionMatcher(["Ferrari", "Aston Martin DB9", "Audi R8"])
+        self.assertEqual(matcher.match('  audi   R8 '), 2)
+        self.assertEqual(matcher.match('1.'), 1)
+        self.assertEqual(matcher.match('fer'), 0)
+        self.assertEqual(matcher.match('the martin db9'), 1)
+        # Ambiguous, or naming no option
+        self.assertIsNone(matcher.match('a'))
+        self.assertIsNone(matcher.match('audi or ferrari'))
+        self.assertIsNone(matcher.match('3'))
+        self.assertIsNone(matcher.match('porsche'))
+
+    def test_options_win_over_numbers(self):
+        matcher = OptionMatcher(["2", "1", "0"])
+        self.assertEqual(matcher.match('1'), 1)
+        self.assertEqual(matcher.match('2.'), 2)
+
+
+class PresenceTest(SimpleTestCase):
+    def test_cap_and_expiry(self):
+        room_name = test_room()
+        presence = Presence(redis_or_skip(), capacity=1, ttl=0.2)
+        other_worker = Presence(redis_or_skip(), capacity=1, ttl=0.2)
+        self.assertTrue(other_worker.join(room_name, '/chat:a'))
+        self.assertFalse(presence.join(room_name, '/chat:b'))
+
+        # The members of a live worker are kept alive by its heartbeats
+        time.sleep(0.15)
+        other_worker.heartbeat()
+        time.sleep(0.1)
+        self.assertFalse(presence.join(room_name, '/chat:b'))
+        self.assertEqual(presence.occupancy([room_name]), {room_name: 1})
+
+        # Until the worker goes away
+        time.sleep(0.25)
+        self.assertEqual(presence.occupancy([room_name]), {room_name: 0})
+        self.assertTrue(presence.join(room_name, '/chat:b'))
+
+    def test_prune(self):
+        room_name = test_room()
+        presence = Presence(redis_or_skip(), ttl=0.2)
+        other_worker = Presence(redis_or_skip(), ttl=0.2)
+        other_worker.join(room_name, '/chat:a')
+        presence.join(room_name, '/chat:b')
+        time.sleep(0.15)
+        presence.heartbeat()
+        time.sleep(0.1)
+        # Reaping a conversation of the room only drops the expired members
+        self.assertEqual(presence.prune(room_name), 1)
+        self.assertEqual(presence.occupancy([room_name]), {room_name: 1})
+
+    def test_release(self):
+        room_name = test_room()
+        presence = Presence(redis_or_skip(), capacity=2)
+        presence.join(room_name, '/chat:a')
+        presence.join(room_name, '/admin:b')
+        presence.join(test_room(), '/chat:c')
+        # A drained worker releases the sockets it had joined
+        self.assertEqual(presence.release(['/chat:a', '/admin:b']), 2)
+        self.assertEqual(presence.occupancy([room_name]), {room_name: 0})
+
+
+class RateLimiterTest(SimpleTestCase):
+    def test_buckets(self):
+        limiter = RateLimiter(redis_or_skip(), {'sid': (1, 2), 'room': (0, 5)})
+        sid = uuid.uuid4().hex
+        self.assertEqual(limiter.acquire(sid=sid, room='lobby'), 0)
+        self.assertEqual(limiter.acquire(sid=sid, room='lobby'), 0)
+        self.assertAlmostEqual(limiter.acquire(sid=sid, room='lobby'), 1, delta=0.1)
+        self.assertEqual(limiter.acquire(sid=uuid.uuid4().hex), 0)
+
+    def test_all_or_nothing(self):
+        limiter = RateLimiter(redis_or_skip(), {'sid': (1, 5), 'room': (1, 1)})
+        sid, room_name = uuid.uuid4().hex, test_room()
+        self.assertEqual(limiter.acquire(sid=sid, room=room_name), 0)
+        # The room bucket is empty, so the socket bucket is not drawn from
+        for _ in range(5):
+            self.assertGreater(limiter.acquire(sid=sid, room=room_name), 0)
+        self.assertEqual(limiter.acquire(sid=sid), 0)
+
+
+def test_message(room_name, room_id, msg_num, message='hello'):
+    return {'chat_room': room_name, 'room_id': str(room_id), 'user_name': 'AnonymousUser',
+            'msg_num': msg_num, 'message': message}
+
+
+class RecordsTest(SimpleTestCase):
+    def test_round_trip(self):
+        content = test_message('lobby~a', uuid.uuid4(), 7, 'héllo')
+        fields = {'chat_room': content['chat_room'], 'room_id': content['room_id']}
+        self.assertEqual(unpack_message('7', pack_message(content), fields), content)
+        self.assertEqual(unpack_history(pack_history(content)),
+                         {'msg_num': 7, 'user_name': 'AnonymousUser', 'message': 'héllo'})
+
+
+class SegmentArchiveTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.room_id = uuid.uuid4()
+
+    def test_sparse_msg_nums(self):
+        backend = SegmentLogArchiveBackend(self.directory)
+        backend.write_batch('r', [test_message('r', self.room_id, n) for n in (1, 50, 900)])
+        backend.write_batch('s', [test_message('s', self.room_id, 3)])
+        msg_nums = lambda msgs: [content['msg_num'] for content in msgs]
+        self.assertEqual(msg_nums(backend.read_history('r', self.room_id, start=10)), [50, 900])
+        self.assertEqual(msg_nums(backend.read_history('r', self.room_id, start=2, stop=900)), [50])
+        self.assertEqual(msg_nums(backend.read_recent('r', self.room_id, 2)), [50, 900])
+        self.assertEqual(msg_nums(backend.read_recent('s', self.room_id, 5)), [3])
+
+    def test_rebuild_index(self):
+        SegmentLogArchiveBackend(self.directory).write_batch(
+            'r', [test_message('r', self.room_id, n) for n in (1, 2)])
+        for name in os.listdir(self.directory):
+            if name.endswith('.index'):
+                os.remove(os.path.join(self.directory, name))
+        backend = SegmentLogArchiveBackend(self.directory)
+        self.assertEqual(len(backend.read_recent('r', self.room_id, 5)), 2)
+        self.assertEqual(backend.read_recent('s', self.room_id, 5), [])
+
+    def test_without_fcntl(self):
+        # Eg: on Windows
+        self.addCleanup(setattr, archive, 'fcntl', archive.fcntl)
+        archive.fcntl = None
+        with self.assertRaises(ImproperlyConfigured):
+            SegmentLogArchiveBackend(self.directory)
+
+
+class ORMArchiveTest(TestCase):
+    def test_read(self):
+        room = ChatRoom.objects.create(room_name='lobby~archive')
+        backend = ORMArchiveBackend()
+        backend.write_bulk([test_message(room.room_name, room.uuid, n) for n in (1, 50, 900)])
+        # Archived again, eg: by a dbupdate
+        backend.write_bulk([test_message(room.room_name, room.uuid, 50)])
+        self.assertEqual([content['msg_num'] for content in backend.read_history(
+            room.room_name, room.uuid, start=10)], [50, 900])
+        self.assertEqual([content['msg_num'] for content in backend.read_recent(
+            room.room_name, room.uuid, 2)], [50, 900])
+
+
+class RetentionTest(TestCase):
+    def setUp(self):
+        self.room = ChatRoom.objects.create(room_name='lobby~retention')
+        ORMArchiveBackend().write_bulk([
+            test_message(self.room.room_name, self.room.uuid, msg_num, f"message {msg_num}")
+            for msg_num in range(1, 8)
+        ])
+        ChatboxMessage.objects.filter(msg_num__lte=5).update(created_on=timezone.now() - timedelta(days=40))
+
+    def test_compaction(self):
+        self.assertEqual(apply_retention(30, {'lobby': 30}, batch_size=2), {'lobby': 5, None: 0})
+        self.assertEqual(list(ChatboxMessage.objects.values_list('msg_num', flat=True).order_by('msg_num')),
+                         [6, 7])
+        # One chunk per batch
+        transcript = ChatTranscript.objects.get(room_id=self.room)
+        self.assertEqual((transcript.first_msg, transcript.last_msg, transcript.num_msgs), (1, 5, 5))
+        self.assertEqual(transcript.chunks.count(), 3)
+        self.assertEqual([line[0] for line in read_transcript(transcript)], [1, 2, 3, 4, 5])
+
+    def test_search_index(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        index = SearchIndex(os.path.join(directory.name, 'search.sqlite3'))
+        index.index_batch(ORMArchiveBackend().read_history(self.room.room_name, self.room.uuid))
+        apply_retention(30, {'lobby': 30}, batch_size=2, search_index=index)
+        self.assertEqual(sorted(hit['msg_num'] for hit in index.search('message')[0]), [6, 7])
+
+
+class SearchIndexTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.index = SearchIndex(os.path.join(self.directory, 'search.sqlite3'))
+
+    def test_index_and_remove(self):
+        room_id = uuid.uuid4()
+        batch = [test_message('r', room_id, 1, 'audi r8'), test_message('r', room_id, 2, 'ferrari')]
+        self.assertEqual(self.index.index_batch(batch), 2)
+        # Archived twice, indexed once
+        self.assertEqual(self.index.index_batch(batch), 0)
+        hits, has_more = self.index.search('aud')
+        self.assertEqual([(hit['room'], hit['msg_num']) for hit in hits], [('r', 1)])
+        self.assertFalse(has_more)
+        self.assertEqual(self.index.remove([('r', 1), ('r', 3)]), 1)
+        self.assertEqual(self.index.search('audi'), ([], False))
+
+    def test_prune_segments(self):
+        segments = os.path.join(self.directory, 'archive')
+        batch = [test_message('r', uuid.uuid4(), n, 'audi') for n in (1, 2)]
+        SegmentLogArchiveBackend(segments).write_batch('r', batch)
+        self.index.index_batch(batch)
+        # Make the segment a year old
+        for name in os.listdir(segments):
+            os.rename(os.path.join(segments, name),
+                      os.path.join(segments, '2000-01-01' + os.path.splitext(name)[1]))
+        self.assertEqual(prune_segments(segments, 30, self.index), 1)
+        self.assertEqual(os.listdir(segments), [])
+        self.assertEqual(self.index.search('audi'), ([], False))
+
+
+class DrainTest(TransactionTestCase):
+    def setUp(self):
+        if not events.local_backend():
+            redis_or_skip()
+        self.server = socketio.Server(async_mode='threading')
+        self.addCleanup(setattr, events, 'DRAINING', False)
+
+    def test_drain(self):
+        room = ChatRoom.objects.create(room_name=conversation_name(test_room(), 'visitorAAAA'))
+        for msg_num in (1, 2, 3):
+            events.update_session_redis(room.room_name, msg_num,
+                                        test_message(room.room_name, room.uuid, msg_num))
+        sid = self.server.manager.connect(uuid.uuid4().hex, '/chat')
+        self.server.manager.enter_room(sid, '/chat', room.room_name)
+        events.get_presence().join(base_room(room.room_name), presence_member('/chat', sid))
+
+        self.assertEqual(events.drain(self.server, deadline=10), (1, 3, 0))
+        self.assertTrue(events.DRAINING)
+        self.assertEqual(ChatboxMessage.objects.filter(room_id=room).count(), 3)
+        self.assertEqual(events.get_cache().hgetall(messages_key(room.room_name)), {})
+        # The socket no longer holds a place in the room
+        self.assertEqual(events.get_presence().occupancy([base_room(room.room_name)]),
+                         {base_room(room.room_name): 0})
+        events.get_cache().delete(history_key(room.room_name))
+
+
+class ReaperTest(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(setattr, events, 'PRESENCE', events.PRESENCE)
+        events.PRESENCE = LocalPresence()
+
+    def test_skip_members(self):
+        claimer = LocalIdleRoomClaimer(idle_timeout=0)
+        conversation = conversation_name(test_room(), 'visitorAAAA')
+        claimer.touch(conversation)
+        self.assertTrue(events.join_presence('/chat', 'a', conversation))
+        # The visitor is quiet, but still there
+        self.assertEqual(events.reap_idle_rooms(claimer, 10), 0)
+        self.assertEqual(claimer.claim(10), [conversation])
+        events.leave_presence('/chat', 'a', conversation)
+        self.assertEqual(events.get_presence().occupancy([conversation, base_room(conversation)]),
+                         {conversation: 0, base_room(conversation): 0})
+
+
+class ConversationsTest(SimpleTestCase):
+    def test_names(self):
+        self.assertEqual(conversation_name('lobby', 'visitorAA'), 'lobby~visitorAA')
+        self.assertEqual(base_room('lobby~visitorAA'), 'lobby')
+        self.assertEqual(base_room('lobby'), 'lobby')
+        self.assertEqual(visitor_id('visitorAAAA', 'sid'), 'visitorAAAA')
+        # Too short, or not a plain id
+        self.assertEqual(visitor_id('short', 'sid'), 'sid')
+        self.assertEqual(visitor_id('bad~visitor', 'sid'), 'sid')
+
+    def test_rate_limits(self):
+        # Each conversation has a bucket of its own, so two visitors of a room do not throttle each other
+        server = socketio.Server(async_mode='threading')
+        namespace = events.TemplateNamespace('/chat')
+        server.register_namespace(namespace)
+        self.addCleanup(setattr, events, 'RATE_LIMITER', events.RATE_LIMITER)
+        events.RATE_LIMITER = LocalRateLimiter({'sid': (0, 1), 'room': (0.001, 2), 'addr': (0, 1)})
+
+        room_name, admitted = test_room(), {}
+        for visitor in ('visitorAAAA', 'visitorBBBB'):
+            eio_sid = uuid.uuid4().hex
+            server.eio.sockets[eio_sid] = engineio.socket.Socket(server.eio, eio_sid)
+            sid = server.manager.connect(eio_sid, '/chat')
+            conversation = conversation_name(room_name, visitor)
+            admitted[visitor] = [events.admit_message(namespace, sid, conversation, 'hello') for _ in range(3)]
+        self.assertEqual(admitted, {'visitorAAAA': [True, True, False], 'visitorBBBB': [True, True, False]})
+
+
+class ViewsTest(SimpleTestCase):
+    def test_staff_only(self):
+        # The views admit the same users as the admin namespace
+        for user, status in ((AnonymousUser(), 403), (User(username='user'), 403),
+                             (User(username='staff', is_staff=True), 200),
+                             (User(username='root', is_superuser=True), 200)):
+            request = RequestFactory().get('/chatbox/presence/', {'rooms': ''})
+            request.user = user
+            self.assertEqual(views.presence(request).status_code, status, user.username)
 
-# Create your tests here.
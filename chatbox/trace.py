@@ -0,0 +1,170 @@
+"""
+chatbox/trace.py
+
+Records the socket traffic of the namespaces, so that it can be replayed later
+(see `manage.py replay_trace`).
+
+A trace is a stream of msgpack records. The first one is a header, and every
+other one is an event: [microseconds since the start, namespace, event, client, payload].
+The traces are anonymized as they are written:
+* The sids become sequential client numbers.
+* The chat lines keep their length and their whitespace, but every letter and
+  digit becomes 'x', except for the commands ('admin', 'dbupdate'), the options
+  of the chatbot templates and the option numbers, which drive the chatbots.
+* The rooms without a chatbot become sequential room numbers, and the visitor
+  ids (of the payloads and of the conversations) sequential visitor numbers.
+* The connection environ (addresses, headers, cookies) is never written.
+"""
+
+import os
+import re
+import json
+import time
+from glob import glob
+from threading import Lock
+
+import msgpack
+
+from .conversations import CONVERSATION_SEPARATOR, conversation_name
+from .matching import NUMBER_PATTERN, normalize
+
+TRACE_VERSION = 1
+
+# Events whose payload is not recorded
+BARE_EVENTS = ('connect', 'disconnect')
+
+# Events whose 'data' is a room name, rather than a chat line
+ROOM_DATA_EVENTS = ('exit_room',)
+
+
+def template_options(directory):
+    """
+        Gets the options of every chatbot template, casefolded
+    """
+    options = set()
+    for path in glob(os.path.join(directory, '*.json')):
+        with open(path, 'rb') as file_obj:
+            content = json.load(file_obj)
+        for node in content.get('node', []):
+            options.update(option.casefold() for option in node.get('options', []))
+    return options
+
+
+class TraceRecorder():
+    """
+        Appends the events of the namespaces to a trace file.
+        `keep` are the chat lines written as-is, and `rooms` the room names written as-is.
+    """
+    def __init__(self, path, keep=(), rooms=()):
+        self.path = path
+        self.keep = {normalize(line) for line in keep}
+        self.rooms = set(rooms)
+        self.clients = dict()
+        self.num_clients = 0
+        self.room_aliases = dict()
+        self.visitor_aliases = dict()
+        self.lock = Lock()
+        self.start = time.monotonic()
+        self.flushed = self.start
+        self.packer = msgpack.Packer(use_bin_type=True)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Buffered, so that recording an event is a memory copy most of the time
+        self.file = open(path, 'ab', buffering=64 * 1024)
+        self.file.write(self.packer.pack({
+            'version': TRACE_VERSION, 'started': time.time(), 'pid': os.getpid(),
+        }))
+
+
+    def mask(self, line):
+        if normalize(line) in self.keep or NUMBER_PATTERN.match(line.strip()):
+            return line
+        return re.sub(r'\w', 'x', line)
+
+
+    def room(self, room_name):
+        if not isinstance(room_name, str) or room_name.strip() in self.rooms:
+            return room_name
+        if CONVERSATION_SEPARATOR in room_name:
+            room_name, visitor = room_name.split(CONVERSATION_SEPARATOR, 1)
+            return conversation_name(self.room(room_name), self.visitor(visitor))
+        return self.room_aliases.setdefault(room_name, f"room{len(self.room_aliases) + 1}")
+
+
+    def visitor(self, visitor):
+        if not isinstance(visitor, str):
+            return visitor
+        return self.visitor_aliases.setdefault(visitor, f"visitor{len(self.visitor_aliases) + 1:08d}")
+
+
+    def anonymize(self, event, payload):
+        if not isinstance(payload, dict):
+            return None
+        payload = dict(payload)
+        # The livechat grants are secrets
+        payload.pop('token', None)
+        if 'room' in payload:
+            payload['room'] = self.room(payload['room'])
+        if 'visitor' in payload:
+            payload['visitor'] = self.visitor(payload['visitor'])
+        if 'rooms' in payload and isinstance(payload['rooms'], list):
+            payload['rooms'] = [self.room(room_name) for room_name in payload['rooms']]
+        if isinstance(payload.get('data'), str):
+            if event in ROOM_DATA_EVENTS:
+                payload['data'] = self.room(payload['data'])
+            else:
+                payload['data'] = self.mask(payload['data'])
+        return payload
+
+
+    def record(self, namespace, event, args):
+        """
+            Records an event received by a namespace, with the arguments of its handler
+        """
+        now = time.monotonic()
+        elapsed = int((now - self.start) * 1000000)
+        sid = args[0] if args else None
+        with self.lock:
+            if self.file is None:
+                return
+            client = self.clients.get(sid)
+            if event == 'connect' and client is not None:
+                # The server retries the connect handler without the auth argument
+                return
+            if client is None:
+                self.num_clients += 1
+                client = self.clients[sid] = self.num_clients
+            if event == 'disconnect':
+                del self.clients[sid]
+            payload = None
+            if event not in BARE_EVENTS and len(args) > 1:
+                payload = self.anonymize(event, args[1])
+            self.file.write(self.packer.pack([elapsed, namespace, event, client, payload]))
+            # Flush at most once a second, so that a killed worker loses at most a second of traffic
+            if now - self.flushed > 1:
+                self.file.flush()
+                self.flushed = now
+
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_trace(path):
+    """
+        Reads a trace. Returns its header, and the list of its events
+    """
+    with open(path, 'rb') as file_obj:
+        unpacker = msgpack.Unpacker(file_obj, raw=False)
+        header = next(unpacker, None)
+        if not isinstance(header, dict) or header.get('version') != TRACE_VERSION:
+            raise ValueError(f"{path} is not a chat trace")
+        return header, [tuple(record) for record in unpacker]
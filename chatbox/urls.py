@@ -3,6 +3,11 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name = 'index'),
+    path('dashboard/', views.dashboard, name='dashboard'),
+    path('search/', views.search, name='search'),
+    path('funnel/<str:chatbot_user>/', views.funnel, name='funnel'),
+    path('presence/', views.presence, name='presence'),
+    path('profile/', views.profile, name='profile'),
     path('<str:room_name>/', views.room, name='room'),
     path('livechat/<str:room_name>/', views.adminroom, ),
 ]
\ No newline at end of file
@@ -1,67 +1,164 @@
 # Views.py
 import os
+import time
+import uuid
 from itertools import zip_longest
 from threading import Event # Wait for an event to occur
 
 from django.shortcuts import render
+from django.http import JsonResponse, Http404
 from django.db import transaction, IntegrityError
 
-from decouple import Config, RepositoryEnv, UndefinedValueError
-from redis import StrictRedis, WatchError
+from redis import WatchError
 
 import socketio
 
-from .chatbot import room_to_chatbot_user, ChatBotUser
+from .chatbot import room_to_chatbot_user, ChatBotUser, template_path
+from .profiling import read_control, write_control
 from .serializers import ChatBoxMessageSerializer
 from .models import ChatRoom
-from .events import HOST, PORT, PASSWORD
+from .conf import config, get_cache
 from .events import background_handler, TemplateNamespace, AdminNamespace
+from .events import socketio_options, wire_options, get_search_index, get_presence
+from .events import get_profiler, apply_profile_control, get_funnel_recorder, is_staff
 
 async_mode = None
 
-sio = socketio.Server(async_mode=async_mode)
+# The Socket.IO server, created on first use, since its options come from the settings
+SIO = None
 thread = None
 
-# Tracks the total number of users using the admin channel
-num_users = 0
 
-# Maximum number of members in a group
-threshold = 4
+def get_sio():
+    """
+        Gets the Socket.IO server, creating it and registering its namespaces if necessary
+    """
+    global SIO
+    if SIO is None:
+        SIO = socketio.Server(async_mode=async_mode, **socketio_options())
+        SIO.register_namespace(TemplateNamespace('/chat'))
+        SIO.register_namespace(AdminNamespace('/admin'))
+    return SIO
 
 
 def index(request):
     #global thread
     #if thread is None:
-    #    thread = sio.start_background_task(background_handler)
+    #    thread = get_sio().start_background_task(background_handler)
     return render(request, 'chatbox/index.html', {})
 
 
 def room(request, room_name):
     return render(request, 'chatbox/room.html', {
-        'room_name': room_name
+        'room_name': room_name,
+        'wire': wire_options(),
     })
 
 
 def adminroom(request, room_name):
-    if request.user.is_authenticated and request.user.is_superuser:
+    if is_staff(request.user):
         admin = True
     else:
         admin = False
 
-    context = { 'room_name' : room_name, 'admin': admin }
+    context = { 'room_name' : room_name, 'admin': admin, 'wire': wire_options() }
     return render(request, 'chatbox/admin_room.html', context)
 
 
+def dashboard(request):
+    admin = is_staff(request.user)
+    return render(request, 'chatbox/dashboard.html', { 'admin': admin, 'wire': wire_options() })
+
+
+def search(request):
+    # Full-text search over the archived messages, for the admins
+    if not is_staff(request.user):
+        return JsonResponse({'error': 'Only admins can search the chat history'}, status=403)
+    if not config.SEARCH_ENABLED:
+        return JsonResponse({'error': 'Search is disabled'}, status=404)
+
+    query = request.GET.get('q', '')
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = min(max(int(request.GET.get('page_size', 20)), 1), 100)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid page'}, status=400)
+
+    hits, has_more = get_search_index().search(query, page, page_size)
+    return JsonResponse({'query': query, 'page': page, 'hits': hits, 'has_more': has_more})
+
+
+def funnel(request, chatbot_user):
+    # The funnel report of a template chatbot, for the admins
+    if not is_staff(request.user):
+        return JsonResponse({'error': 'Only admins can view the funnel reports'}, status=403)
+    if not config.FUNNEL_ENABLED:
+        return JsonResponse({'error': 'Funnel analytics are disabled'}, status=404)
+    try:
+        minutes = min(max(int(request.GET.get('minutes', 0)), 0), 24 * 60)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid minutes'}, status=400)
+
+    try:
+        content, _ = ChatBotUser.process_template(template_path(chatbot_user))
+    except FileNotFoundError:
+        raise Http404(f"No template for {chatbot_user}")
+
+    report = get_funnel_recorder().report(chatbot_user, content, minutes)
+    return JsonResponse({'bot': chatbot_user, 'nodes': report})
+
+
+def presence(request):
+    # The number of members of the rooms (?rooms=lobby,default), for the dashboards
+    if not is_staff(request.user):
+        return JsonResponse({'error': 'Only admins can view the room presence'}, status=403)
+    rooms = [room.strip() for room in request.GET.get('rooms', '').split(',') if room.strip()]
+    if len(rooms) > 1000:
+        return JsonResponse({'error': 'Too many rooms'}, status=400)
+    return JsonResponse({'rooms': get_presence().occupancy(rooms)})
+
+
+def profile(request):
+    # Switches the profiler of every worker on (or off), for the admins.
+    # POST action=start (with sample_rate and duration, in seconds) or action=stop
+    if not is_staff(request.user):
+        return JsonResponse({'error': 'Only admins can profile the server'}, status=403)
+
+    control = read_control(get_cache())
+    if request.method == 'POST':
+        action = request.POST.get('action')
+        if action == 'start':
+            try:
+                sample_rate = float(request.POST.get('sample_rate', 0.1))
+                duration = int(request.POST.get('duration', 60))
+            except ValueError:
+                return JsonResponse({'error': 'Invalid sample rate or duration'}, status=400)
+            if not 0 < sample_rate <= 1 or not 0 < duration <= config.PROFILE_MAX_DURATION:
+                return JsonResponse({'error': 'Invalid sample rate or duration'}, status=400)
+            control = {
+                'session': uuid.uuid4().hex[:12],
+                'sample_rate': sample_rate,
+                'until': time.time() + duration,
+            }
+        elif action == 'stop' and control is not None:
+            control['until'] = time.time()
+        elif action != 'stop':
+            return JsonResponse({'error': 'Invalid action'}, status=400)
+        if control is not None:
+            write_control(get_cache(), control)
+
+    # Apply it right away on this worker. The others pick it up in the background
+    apply_profile_control(control)
+    return JsonResponse({'control': control, 'worker': get_profiler().status()})
+
+
 def get_user():
     # TODO: Get the user name for the session info from the client
     return 'AnonymousUser'
 
 
-# Register the namespaces
-sio.register_namespace(TemplateNamespace('/chat'))
-sio.register_namespace(AdminNamespace('/admin'))
-
 # Connect to a Redis Queue as an external process
 #external_sio = socketio.KombuManager(
-#    url=f"redis://{HOST}:{PORT}", redis_options={'password': PASSWORD}
+#    url=f"redis://{config.REDIS_SERVER_HOST}:{config.REDIS_SERVER_PORT}",
+#    redis_options={'password': config.REDIS_SERVER_PASSWORD}
 #    )
@@ -0,0 +1,74 @@
+"""
+chatbox/wire.py
+
+The payload schema of the chat events sent over the socket.
+
+With compact payloads, the long keys and the message type of the chat events
+are replaced by short codes. The client gets the same schema through the page
+context, and expands the payloads back (see `chatbox/socketio_client.html`).
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+
+# Long key -> short key, for the payloads of the chat events
+CHAT_KEYS = {
+    'type': 't',
+    'room_name': 'r',
+    'data': 'd',
+    'message_type': 'm',
+    'user': 'u',
+}
+
+# Value of 'type' -> short code
+CHAT_TYPES = {
+    'chat_message_to_client': 1,
+}
+
+# The serializers of the socket.io packets
+SERIALIZERS = ('default', 'msgpack')
+
+
+def check_serializer(serializer):
+    """
+        Checks that the serializer of the socket.io packets is a known one
+    """
+    if serializer not in SERIALIZERS:
+        raise ImproperlyConfigured(
+            f"Unknown SOCKETIO_SERIALIZER {serializer!r}, expected one of {', '.join(SERIALIZERS)}"
+        )
+    return serializer
+
+
+def compact_payload(payload):
+    """
+        Shortens the keys and the type of a chat event payload
+    """
+    content = {CHAT_KEYS.get(key, key): value for key, value in payload.items()}
+    if 't' in content:
+        content['t'] = CHAT_TYPES.get(content['t'], content['t'])
+    return content
+
+
+def expand_payload(content):
+    """
+        Restores a payload shortened by `compact_payload`
+    """
+    keys = {short: key for key, short in CHAT_KEYS.items()}
+    types = {code: value for value, code in CHAT_TYPES.items()}
+    payload = {keys.get(key, key): value for key, value in content.items()}
+    if 'type' in payload:
+        payload['type'] = types.get(payload['type'], payload['type'])
+    return payload
+
+
+def client_options(serializer, compact, transports):
+    """
+        The wire options which the client needs, passed through the page context
+    """
+    return {
+        'serializer': serializer,
+        'compact': compact,
+        'transports': transports,
+        'keys': {short: key for key, short in CHAT_KEYS.items()},
+        'types': {str(code): value for value, code in CHAT_TYPES.items()},
+    }
@@ -2,6 +2,8 @@
 WSGI config for django_example project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
+Importing this module has no side effects: the worker is started by the
+``post_worker_init`` hook of gunicorn (see gunicorn.conf.py), or by ``serve()``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/1.11/howto/deployment/wsgi/
@@ -12,16 +14,46 @@ import os
 from django.core.wsgi import get_wsgi_application
 import socketio
 
-from chatbox.views import sio
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chatbox_socketio.settings")
 django_app = get_wsgi_application()
-application = socketio.Middleware(sio, django_app)
 
-import eventlet
-import eventlet.wsgi
-eventlet.wsgi.server(eventlet.listen(('', 8000)), application)
+from chatbox.views import get_sio
+
+
+class Application():
+    """
+        Serves Socket.IO and Django, building the Socket.IO server (which reads the settings)
+        on the first request, unless the worker has been started already
+    """
+    def __init__(self):
+        self.app = None
+
+    def __call__(self, environ, start_response):
+        if self.app is None:
+            self.app = socketio.Middleware(get_sio(), django_app)
+        return self.app(environ, start_response)
+
+
+application = Application()
+
+
+def serve(port=8000):
+    """
+        Runs the eventlet server, after starting the worker
+    """
+    import eventlet
+    import eventlet.wsgi
+    from chatbox.events import start_worker
+
+    # Connect to the Redis store, start the background tasks,
+    # and archive the live sessions before shutting down
+    start_worker(get_sio())
+    eventlet.wsgi.server(eventlet.listen(('', port)), application)
+
+
+if __name__ == '__main__':
+    serve()
 
 
 #django_app = get_wsgi_application()
-#application = socketio.WSGIApp(sio, django_app)
\ No newline at end of file
+#application = socketio.WSGIApp(get_sio(), django_app)
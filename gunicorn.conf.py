@@ -0,0 +1,7 @@
+# gunicorn settings, picked up from the working directory
+
+def post_worker_init(worker):
+    # Start the worker once it is up, rather than when the application is imported
+    from chatbox.views import get_sio
+    from chatbox.events import start_worker
+    start_worker(get_sio())